@@ -1,5 +1,4 @@
-from gensim.models import Word2Vec  # type: ignore
-from gensim.models import FastText  # type: ignore
+from typing import Iterator, Mapping
 
 """
 class GloVe:
@@ -28,25 +27,47 @@ class GloVe:
             setattr(result, k, deepcopy(v, memo))
         return result    
 """
-algos = {
-    "model": Word2Vec,
-    "w2v": Word2Vec,
-    "w2v2": Word2Vec,
-    "w2v3": Word2Vec,
-    "w2v4": Word2Vec,
-    "fasttext": FastText,
-    "ft": FastText,
-    "ft2": FastText,
-    "ft3": FastText,
-    "ft4": FastText,
+
+
+class GensimModels(Mapping):
+    """algo -> gensim model class, gensim is imported at the first lookup"""
+
+    def __init__(self, names: dict[str, str]):
+        self.names = names
+
+    def __getitem__(self, algo: str):
+        import gensim.models  # type: ignore
+
+        return getattr(gensim.models, self.names[algo])
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+
+algo_names = {
+    "model": "Word2Vec",
+    "w2v": "Word2Vec",
+    "w2v2": "Word2Vec",
+    "w2v3": "Word2Vec",
+    "w2v4": "Word2Vec",
+    "fasttext": "FastText",
+    "ft": "FastText",
+    "ft2": "FastText",
+    "ft3": "FastText",
+    "ft4": "FastText",
 }
 
-reverse_algos = {}
-for k, v in algos.items():
-    if v.__name__ not in reverse_algos:
-        reverse_algos[v.__name__] = [k]
+algos = GensimModels(algo_names)
+
+reverse_algos: dict[str, list[str]] = {}
+for k, v in algo_names.items():
+    if v not in reverse_algos:
+        reverse_algos[v] = [k]
     else:
-        reverse_algos[v.__name__] += [k]
+        reverse_algos[v] += [k]
 
 algo = "fasttext"
 # algo = "w2v"
@@ -0,0 +1,192 @@
+"""Bulk ingestion of tokenized texts.
+Ids are assigned on the client, so rows never need a round trip to learn their keys.
+Rows are buffered and streamed through COPY on PostgreSQL,
+everywhere else they are written with executemany batches.
+With arrays storage (settings.STORAGE) sentences and postings replace the words."""
+
+import csv
+import io
+
+from sqlalchemy import func, insert, text  # type: ignore
+from sqlalchemy.schema import Table  # type: ignore
+
+from db import Session
+from settings import STORAGE
+from customtypes import ParsedText
+from model import Text, Sentence, Word, Stem, Form, Posting
+from util import pack_ids
+
+BATCH_SIZE = 50_000
+"""Number of buffered words that triggers a flush"""
+
+
+def csv_value(value):
+    """COPY takes binary values in the hex format of bytea"""
+    return "\\x" + value.hex() if isinstance(value, bytes) else value
+
+
+class BulkLoader:
+    def __init__(self, s: Session, batch_size: int = BATCH_SIZE, storage=STORAGE):
+        self.s = s
+        self.batch_size = batch_size
+        self.arrays = storage == "arrays"
+        self.is_postgres = s.get_bind().dialect.name == "postgresql"
+        self.tables: list[Table] = [
+            Form.__table__,
+            Text.__table__,
+            Sentence.__table__,
+            Word.__table__,
+            Posting.__table__,
+            Stem.__table__,
+        ]
+        self.rows: dict[str, list[dict]] = {t.name: [] for t in self.tables}
+        self.next_ids: dict[str, int] = {}
+        self.form_ids: dict[str, int] = {}
+
+    def reserve(self, table: Table, n: int) -> int:
+        """Reserves n consecutive ids for the table and returns the first one.
+        Assumes a single writer, as populate.py is."""
+        if not n:
+            return 0
+        if self.is_postgres:
+            seq = f"pg_get_serial_sequence('{table.name}', 'id')"
+            last = self.s.execute(
+                text(f"SELECT setval({seq}, nextval({seq}) + :n - 1)"), {"n": n}
+            ).scalar()
+            return last - n + 1
+        if table.name not in self.next_ids:
+            last = self.s.query(func.max(table.c.id)).scalar()
+            self.next_ids[table.name] = (last or 0) + 1
+        first = self.next_ids[table.name]
+        self.next_ids[table.name] += n
+        return first
+
+    def add_text(self, parsed: ParsedText) -> int:
+        """Buffers a text with its sentences and words, returns the text id"""
+        text_id = self.reserve(Text.__table__, 1)
+        self.rows["texts"] += [
+            {
+                "id": text_id,
+                "name": parsed.name,
+                "fname": parsed.fname,
+                "corpus": parsed.corpus,
+                "fulltext": parsed.fulltext,
+                "content_hash": parsed.content_hash,
+            }
+        ]
+        sentences = parsed.sentences
+        sent_id = self.reserve(Sentence.__table__, len(sentences))
+        if self.arrays:
+            self.add_arrays(text_id, sent_id, parsed)
+            return text_id
+        word_id = self.reserve(Word.__table__, sum(len(x) for x in sentences))
+        for i, (sentence, (start, end), offsets) in enumerate(
+            zip(sentences, parsed.spans, parsed.offsets)
+        ):
+            self.rows["sentences"] += [
+                {
+                    "id": sent_id,
+                    "sentence": " ".join(sentence),
+                    "order": i,
+                    "text_id": text_id,
+                    "char_start": start,
+                    "char_end": end,
+                }
+            ]
+            for j, (word, (word_start, word_end)) in enumerate(zip(sentence, offsets)):
+                self.rows["words"] += [
+                    {
+                        "id": word_id,
+                        "word": word,
+                        "order": j,
+                        "sentence_id": sent_id,
+                        "char_start": word_start,
+                        "char_end": word_end,
+                    }
+                ]
+                word_id += 1
+            sent_id += 1
+        if len(self.rows["words"]) >= self.batch_size:
+            self.flush()
+        return text_id
+
+    def add_arrays(self, text_id: int, sent_id: int, parsed: ParsedText) -> None:
+        """Buffers each sentence as an array of form ids, with its postings"""
+        sentences = parsed.sentences
+        if not self.form_ids:
+            self.form_ids = dict(self.s.query(Form.word, Form.id))
+        new = [
+            word
+            for word in dict.fromkeys(w for sentence in sentences for w in sentence)
+            if word not in self.form_ids
+        ]
+        form_id = self.reserve(Form.__table__, len(new))
+        for word in new:
+            self.form_ids[word] = form_id
+            self.rows["forms"] += [{"id": form_id, "word": word}]
+            form_id += 1
+        for i, (sentence, (start, end), offsets) in enumerate(
+            zip(sentences, parsed.spans, parsed.offsets)
+        ):
+            forms = [self.form_ids[word] for word in sentence]
+            self.rows["sentences"] += [
+                {
+                    "id": sent_id,
+                    "sentence": "",
+                    "order": i,
+                    "text_id": text_id,
+                    "forms": pack_ids(forms),
+                    "char_start": start,
+                    "char_end": end,
+                    "offsets": pack_ids([o for offset in offsets for o in offset]),
+                }
+            ]
+            positions: dict[int, list[int]] = {}
+            for j, form in enumerate(forms):
+                positions.setdefault(form, []).append(j)
+            self.rows["postings"] += [
+                {
+                    "form_id": form,
+                    "sentence_id": sent_id,
+                    "positions": pack_ids(found),
+                    "freq": len(found),
+                }
+                for form, found in positions.items()
+            ]
+            sent_id += 1
+        if len(self.rows["postings"]) >= self.batch_size:
+            self.flush()
+
+    def add_stems(self, rows: list[dict]) -> None:
+        """Buffers (stemmer, word, token) rows, keyed by stemmer and word"""
+        self.rows["stems"] += rows
+
+    def flush(self) -> None:
+        """Writes all buffered rows, parents before children"""
+        for table in self.tables:
+            rows = self.rows[table.name]
+            if not rows:
+                continue
+            if self.is_postgres:
+                self.copy(table, rows)
+            else:
+                self.s.execute(insert(table), rows)
+            self.rows[table.name] = []
+
+    def copy(self, table: Table, rows: list[dict]) -> None:
+        cols = list(rows[0].keys())
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerows([csv_value(r[c]) for c in cols] for r in rows)
+        buf.seek(0)
+        quoted = ", ".join(f'"{c}"' for c in cols)
+        cursor = self.s.connection().connection.cursor()
+        cursor.copy_expert(
+            f"COPY {table.name} ({quoted}) FROM STDIN"
+            f" WITH (FORMAT csv, FORCE_NOT_NULL ({quoted}))",
+            buf,
+        )
+
+    def commit(self) -> None:
+        self.flush()
+        self.s.commit()
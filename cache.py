@@ -0,0 +1,243 @@
+"""Cache of the pages rendered by main.py.
+A page is a function of its path and of the data, so entries are keyed on the path
+and on the generation of the dataset: a counter bumped whenever the data changes
+(populate.py, vocabulary edits). A new generation makes every entry stale at once,
+and ETags derived from path and generation are checked without rendering anything."""
+
+from typing import Optional
+
+import os
+import re
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+
+import anyio.to_thread  # type: ignore
+from starlette.datastructures import Headers, MutableHeaders  # type: ignore
+from starlette.types import ASGIApp, Message, Receive, Scope, Send  # type: ignore
+
+from settings import db_dir, VOCAB, CORPORA
+
+generation_file = f"{db_dir}/{VOCAB}.{CORPORA}.generation"
+
+Entry = tuple[str, bytes]
+"""Content type and body of a response"""
+
+
+def generation() -> int:
+    """The generation of the dataset, 0 before the first bump"""
+    try:
+        with open(generation_file) as f:
+            return int(f.read() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def bump_generation() -> int:
+    """Marks all cached pages as stale, in every process. Returns the new generation"""
+    new = generation() + 1
+    if not os.path.exists(db_dir):
+        os.mkdir(db_dir)
+    tmp = f"{generation_file}.{os.getpid()}"
+    with open(tmp, "w") as f:
+        f.write(str(new))
+    # readers never see a partial write
+    os.replace(tmp, generation_file)
+    return new
+
+
+class ResponseCache:
+    """LRU of responses of the current generation, bounded in bytes.
+    Responses over max_entry_bytes, max_bytes / 8 by default, are not kept.
+    With a spill_dir, entries evicted from memory are written there up to spill_bytes,
+    the files are shared by all the processes serving the same dataset.
+    Memory is accessed under a lock, files by read_spilled() and spill(),
+    that block and are meant to run in a thread."""
+
+    def __init__(
+        self,
+        max_bytes: int,
+        spill_dir: str = "",
+        spill_bytes: int = 0,
+        max_entry_bytes: Optional[int] = None,
+    ):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = (
+            max_bytes // 8 if max_entry_bytes is None else max_entry_bytes
+        )
+        self.spill_dir = spill_dir
+        self.spill_bytes = spill_bytes
+        self.entries: OrderedDict[str, Entry] = OrderedDict()
+        self.size = 0
+        self.generation = -1
+        self.lock = threading.Lock()
+
+    def renew(self, generation: int) -> bool:
+        """Drops the entries of older generations.
+        Returns whether the generation is current, a request that started
+        before the last bump is not to read or write entries"""
+        if generation < self.generation:
+            return False
+        if generation == self.generation:
+            return True
+        self.entries.clear()
+        self.size = 0
+        self.generation = generation
+        return True
+
+    def spill_path(self, generation: int, key: str) -> str:
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return f"{self.spill_dir}/{generation}/{digest}"
+
+    def get(self, generation: int, key: str) -> Optional[Entry]:
+        """The entry in memory, see read_spilled() for the ones on disk"""
+        with self.lock:
+            if not self.renew(generation) or key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def read_spilled(self, generation: int, key: str) -> Optional[Entry]:
+        """The entry spilled to disk, if any, kept in memory again. Blocking"""
+        if not self.spill_dir:
+            return None
+        try:
+            with open(self.spill_path(generation, key), "rb") as f:
+                content_type, _, body = f.read().partition(b"\n")
+        except FileNotFoundError:
+            return None
+        entry = (content_type.decode(), body)
+        self.spill(generation, self.put(generation, key, entry))
+        return entry
+
+    def put(self, generation: int, key: str, entry: Entry) -> list[tuple[str, Entry]]:
+        """Keeps an entry in memory.
+        Returns the entries evicted meanwhile, to be given to spill()"""
+        if len(key) + len(entry[1]) > self.max_entry_bytes:
+            return []
+        with self.lock:
+            if not self.renew(generation) or key in self.entries:
+                return []
+            self.entries[key] = entry
+            self.size += len(key) + len(entry[1])
+            evicted = []
+            while self.size > self.max_bytes and self.entries:
+                old, (content_type, body) = self.entries.popitem(last=False)
+                self.size -= len(old) + len(body)
+                evicted += [(old, (content_type, body))]
+            return evicted
+
+    def spill(self, generation: int, evicted: list[tuple[str, Entry]]) -> None:
+        """Writes evicted entries to disk, as long as the files of the generation,
+        written by any process, stay within spill_bytes.
+        Removes the files of older generations. Blocking"""
+        if not self.spill_dir or not evicted:
+            return
+        if os.path.isdir(self.spill_dir):
+            for name in os.listdir(self.spill_dir):
+                # newer generations are being filled by other processes
+                if name.isdigit() and int(name) < generation:
+                    shutil.rmtree(f"{self.spill_dir}/{name}", ignore_errors=True)
+        directory = f"{self.spill_dir}/{generation}"
+        os.makedirs(directory, exist_ok=True)
+        spilled = sum(e.stat().st_size for e in os.scandir(directory) if e.is_file())
+        for key, (content_type, body) in evicted:
+            path = self.spill_path(generation, key)
+            if spilled + len(body) > self.spill_bytes or os.path.exists(path):
+                continue
+            tmp = f"{path}.{os.getpid()}"
+            with open(tmp, "wb") as f:
+                f.write(content_type.encode() + b"\n" + body)
+            os.replace(tmp, path)
+            spilled += len(body)
+
+
+class CachedResponses:
+    """ASGI middleware answering GET requests for the given paths from a ResponseCache.
+    Responses carry an ETag derived from path and generation, so a matching
+    If-None-Match is answered with 304 before the page is rendered."""
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        paths: list[str],
+        cache: ResponseCache,
+        cache_control: str = "no-cache",
+    ):
+        self.app = app
+        self.paths = re.compile("|".join(f"(?:{p})" for p in paths))
+        self.cache = cache
+        self.cache_control = cache_control
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "GET"
+            or not self.paths.fullmatch(scope["path"])
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        gen = generation()
+        key = f"{scope['path']}?{scope['query_string'].decode('latin-1')}"
+        etag = f'"{hashlib.sha1(f"{gen}:{key}".encode()).hexdigest()[:20]}"'
+        headers = {"etag": etag, "cache-control": self.cache_control}
+
+        if_none_match = Headers(scope=scope).get("if-none-match", "")
+        if etag in [tag.strip() for tag in if_none_match.split(",")]:
+            await self.respond(send, 304, headers, b"")
+            return
+        entry = self.cache.get(gen, key)
+        if entry is None and self.cache.spill_dir:
+            entry = await anyio.to_thread.run_sync(self.cache.read_spilled, gen, key)
+        if entry:
+            content_type, body = entry
+            await self.respond(
+                send, 200, {**headers, "content-type": content_type}, body
+            )
+            return
+
+        status = 0
+        content_type = ""
+        chunks: list[bytes] = []
+        # None once the response is too large to be cached, e.g. a streamed corpus
+        buffered: Optional[int] = 0
+
+        async def send_and_keep(message: Message) -> None:
+            nonlocal status, content_type, buffered
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if status == 200:
+                    response_headers = MutableHeaders(scope=message)
+                    response_headers.update(headers)
+                    content_type = response_headers.get("content-type", "")
+            elif (
+                message["type"] == "http.response.body"
+                and status == 200
+                and buffered is not None
+            ):
+                body = message.get("body", b"")
+                buffered += len(body)
+                if buffered > self.cache.max_entry_bytes:
+                    buffered = None
+                    chunks.clear()
+                else:
+                    chunks.append(body)
+                if buffered is not None and not message.get("more_body", False):
+                    evicted = self.cache.put(gen, key, (content_type, b"".join(chunks)))
+                    await send(message)
+                    if evicted and self.cache.spill_dir:
+                        await anyio.to_thread.run_sync(self.cache.spill, gen, evicted)
+                    return
+            await send(message)
+
+        await self.app(scope, receive, send_and_keep)
+
+    @staticmethod
+    async def respond(send: Send, status: int, headers: dict[str, str], body: bytes):
+        raw = [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()]
+        if status != 304:
+            raw.append((b"content-length", str(len(body)).encode("latin-1")))
+        await send({"type": "http.response.start", "status": status, "headers": raw})
+        await send({"type": "http.response.body", "body": body})
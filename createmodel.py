@@ -9,9 +9,30 @@ from settings import model_dir
 from corpora import corpora as corpora
 from stemmers import stemmers
 from algo import algos
+from vectors import save_vectors
 
-from util import collect_tokens
-from create import tokenize_values, load_source, calc_occurences, annotate_occurences
+from persistence import tokenize_values, SourceSentences
+
+
+def annotator(valuesbackref: dict[str, str], func_name: str):
+    """Per-sentence create.annotate_occurences(), to annotate a stream of sentences
+
+    Returns:
+        Callable[[List[str]], List[str]]: brackets every keyword with its value
+    """
+    token_func = stemmers[func_name]
+
+    def annotate(sentence: list[str]) -> list[str]:
+        updated = []
+        for token in sentence:
+            stemmed = token_func(token)
+            if stemmed in valuesbackref:
+                updated += [valuesbackref[stemmed], token, valuesbackref[stemmed]]
+            else:
+                updated += [token]
+        return updated
+
+    return annotate
 
 
 def create_models(tkn="sb", algo="w2v", epochs=200):
@@ -19,12 +40,9 @@ def create_models(tkn="sb", algo="w2v", epochs=200):
         os.mkdir(model_dir)
 
     _, valuesbackref = tokenize_values(tkn)
-    _, tokenized = load_source(stemmers["dummy"], corpora)
-    # _, tokenized = load_source(stemmers[tkn], corpora)
-    # occurences, occurences_tv, occurences_backref = calc_occurences(values, tokenized)
-    tokenized = annotate_occurences(tokenized, valuesbackref, tkn)
-
-    all_tokens = collect_tokens(tokenized)
+    annotate = annotator(valuesbackref, tkn)
+    # sentences are streamed from the database at each epoch
+    all_tokens = SourceSentences("dummy", corpora, annotate)
     print(f"all tokens: {sum(len(x) for x in all_tokens)}")
     model = algos[algo](
         sentences=all_tokens,
@@ -48,16 +66,19 @@ def create_models(tkn="sb", algo="w2v", epochs=200):
         )
     print(base_name)
     model.save(base_name)
+    # the vectors alone, as loaded by the pages, see vectors.py
+    save_vectors(model.wv, base_name)
 
     # per-corpus models
     corpora_tokens = []
-    for c in tokenized.keys():
-        p = collect_tokens(tokenized, c)
+    for c in corpora:
+        p = SourceSentences("dummy", [c], annotate)
         print(f"{c} tokens (post annotation): {sum(len(x) for x in p)}")
         corpora_tokens += [p]
         m = copy.deepcopy(model)
         m.train(p, epochs=m.epochs, total_examples=m.corpus_count)
         m.save(base_name.replace("all", c))
+        save_vectors(m.wv, base_name.replace("all", c))
 
 
 if __name__ == "__main__":
@@ -1,4 +1,4 @@
-from typing import TypeAlias
+from typing import NamedTuple, TypeAlias
 
 TokenToClassMap: TypeAlias = dict[str, str]
 ClassToTokenMap: TypeAlias = dict[str, list[str]]
@@ -6,3 +6,21 @@ ClassToTokenMap: TypeAlias = dict[str, list[str]]
 FulltextsMap: TypeAlias = dict[str, dict[str, str]]
 """Text is represented as list of sentences (list of words)"""
 TokenizedMap: TypeAlias = dict[str, dict[str, list[list[str]]]]
+
+
+class ParsedText(NamedTuple):
+    """A text file as read and tokenized, before being stored"""
+
+    corpus: str
+    fname: str
+    name: str
+    fulltext: str
+    content_hash: str
+    sentences: list[list[str]]
+    """words as present in the text"""
+    spans: list[tuple[int, int]]
+    """start and end of each sentence in the cleaned fulltext, see util.clean_text()"""
+    offsets: list[list[tuple[int, int]]]
+    """start and end of each word of the sentences"""
+    stems: dict[str, dict[str, str]]
+    """stemmer -> word -> token, for the distinct words of the text"""
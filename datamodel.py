@@ -1,25 +1,62 @@
-"""The main class that enables annotation of the full-text while processing a stemmed version of it.
-"""
+"""The main class that enables annotation of the full-text while processing a stemmed version of it."""
 
 from re import fullmatch
-from typing import Dict, List, Union
+from typing import Dict, Iterable, List, Tuple, Union
 
-import nltk  # type: ignore
-
-from stemmers import stemmers
+from stemmers import stemmers, stem_many
 from persistence import tokenize_values
-
-regex_token = r"\w+"
-language = "english"
+from resources import sentence_tokenizer, word_tokenizer
+from util import clean_text
 
 from template import span_templ
 
 # nltk.download("punkt")
 
-cleanup_map = {
-    "-\n": "",
-    "ſ": "s",
-}
+
+def annotate_words(
+    text: str, hits: Iterable[Tuple[int, int, str]], values: Dict[str, str]
+) -> str:
+    """The text with the words whose token has a value wrapped in a span, in a single pass.
+    hits are the (start, end, token) of its words in order.
+    >>> annotate_words("A time", [(0, 1, "a"), (2, 6, "time")], {"time": "time"})
+    "A <span id='time-0' class='value time time' title='time'>time</span>"
+    """
+    values_count = {v: 0 for v in set(values.values())}
+    parts = []
+    last = 0
+    for start, end, token in hits:
+        if token not in values:
+            continue
+        value = values[token]
+        parts += [
+            text[last:start],
+            span_templ.format(
+                id=f"{value}-{values_count[value]}",
+                type=f"{token} {value}",
+                title=value,
+                content=text[start:end],
+            ),
+        ]
+        last = end
+    parts += [text[last:]]
+    return "".join(parts)
+
+
+def annotate(
+    fulltext: str, hits: Iterable[Tuple[int, int, str]], values: Dict[str, str]
+) -> str:
+    """The rich text of a cleaned fulltext, see util.clean_text(),
+    with the words annotated by annotate_words() and the paragraphs marked up.
+    >>> annotate("Once upon a time.\\n\\nThe end", [(0, 4, "once"), (12, 16, "time")], {"time": "time"})
+    "<p>Once upon a <span id='time-0' class='value time time' title='time'>time</span>.</p><p>The end</p>"
+    """
+    result = annotate_words(fulltext, hits, values)
+    result = result.replace("\n\n\n", "\n\n")
+    result = result.replace("\n\n", "</p><p>")
+    result = result.replace("\n", "<br/>")
+    result = f"<p>{result}</p>"
+    # return "<p>" + "</p><p>".join(result) + "</p>"
+    return result
 
 
 class Annotator:
@@ -28,11 +65,9 @@ class Annotator:
         self.func_name = tokenizer_name
         # label->value dict
         self.values = values_br if values_br else tokenize_values(tokenizer_name)[1]
-        self.fulltext = fulltext
-        for k, v in cleanup_map.items():
-            self.fulltext = self.fulltext.replace(k, v)
-        self.tokenizer = nltk.tokenize.RegexpTokenizer(regex_token)
-        self.sent_tokenizer = nltk.data.load(f"tokenizers/punkt/{language}.pickle")
+        self.fulltext = clean_text(fulltext)
+        self.tokenizer = word_tokenizer()
+        self.sent_tokenizer = sentence_tokenizer()
 
     def rich_text(self):
         """
@@ -47,54 +82,44 @@ class Annotator:
         >> Annotator('lan', s).rich_text()
         "<p>Three women were changed into flowers which grew in the field, but one of them was allowed to be in her own home at night. Then once when day was drawing near, and she was forced to go back to her companions in the field and become a flower again, she said to her <span id='lov-0' class='husband lov' title='husband'>husband</span>, “If thou wilt come this afternoon and gather me, I shall be set <span id='fre-0' class='fre fre' title='free'>free</span> and henceforth stay with thee.” And he did so. Now the question is, how did her <span id='lov-0' class='husband lov' title='husband'>husband</span> <span id='know-0' class='know know' title='know'>know</span> her, for the flowers were exactly alike, and without any difference? Answer: as she was at her home during the night and not in the field, no dew fell on her as it did on the others, and by this her <span id='lov-0' class='husband lov' title='husband'>husband</span> knew her.</p>"
         """
-        values_count = {v: 0 for v in set(self.values.values())}
-        # print(len(tokens), tokens)
-        result = []
+        return annotate(self.fulltext, self.hits(), self.values)
+
+    def rich_line(self) -> str:
+        """The rich text without paragraphs, e.g. of a title
+        >>> Annotator("dummy", "A good time", {"time": "time"}).rich_line()
+        "A good <span id='time-0' class='value time time' title='time'>time</span>"
+        """
+        return annotate_words(self.fulltext, self.hits(), self.values)
+
+    def hits(self) -> List[Tuple[int, int, str]]:
+        """(start, end, token) of the words of the fulltext"""
+        spans = []
+        offset = 0
         for paragraph in self.fulltext.split("\n"):
-            # print(paragraph)
-            tokens = self.tokens(paragraph)
-            sentences = self.sent_tokenizer.tokenize(paragraph)
-            # print(sentences)
-            sent_spans = list(self.sent_tokenizer.span_tokenize(paragraph))
-            # print(sent_spans)
-            annotated_text = paragraph
-            for i, sentence in reversed(list(enumerate(sentences))):
-                ranges = list(self.tokenizer.span_tokenize(sentence))
-                doc = self.tokenizer.tokenize(sentence)
-                annotated_sentence = sentence
-                for j, t in reversed(list(enumerate(doc))):
-                    if tokens[i][j] in self.values.keys():
-                        value = self.values[tokens[i][j]]
-                        sid = f"{value}-{values_count[value]}"
-                        stype = f"{tokens[i][j]} {value}"
-                        title = value
-                        # title = annotated_sentence[ranges[j][0] : ranges[j][1]]
-                        annotated_sentence = (
-                            annotated_sentence[: ranges[j][0]]
-                            + span_templ.format(
-                                id=sid,
-                                type=stype,
-                                title=title,
-                                content=t,
-                            )
-                            + annotated_sentence[ranges[j][1] :]
-                        )
-                annotated_text = (
-                    annotated_text[: sent_spans[i][0]]
-                    + annotated_sentence
-                    + annotated_text[sent_spans[i][1] :]
-                )
-            # print(annotated_text)
-            # if annotated_text:
-            result += [annotated_text]
+            spans += [
+                (offset + start, offset + end)
+                for start, end in self.word_spans(paragraph)
+            ]
+            offset += len(paragraph) + 1
+        # stems do not depend on the context, all the words are stemmed at once
+        words = [self.fulltext[start:end] for start, end in spans]
+        tokens = stem_many(self.func_name, words)
+        return [(start, end, token) for (start, end), token in zip(spans, tokens)]
 
-        result = "\n".join(result)
-        result = result.replace("\n\n\n", "\n\n")
-        result = result.replace("\n\n", "</p><p>")
-        result = result.replace("\n", "<br/>")
-        result = f"<p>{result}</p>"
-        # return "<p>" + "</p><p>".join(result) + "</p>"
-        return result
+    def word_spans(self, paragraph: str) -> List[Tuple[int, int]]:
+        """(start, end) of the words of a paragraph, split as tokens() does,
+        sentence by sentence
+        >>> Annotator("dummy", "", {"time": "time"}).word_spans("Once upon a time. Then it ends!")
+        [(0, 4), (5, 9), (10, 11), (12, 16), (18, 22), (23, 25), (26, 30)]
+        """
+        spans = []
+        for start, end in self.sent_tokenizer.span_tokenize(paragraph):
+            sentence = paragraph[start:end]
+            spans += [
+                (start + first, start + last)
+                for first, last in self.tokenizer.span_tokenize(sentence)
+            ]
+        return spans
 
     def tokens(self, fulltext) -> List[List[str]]:
         """get the text of the story and returns a list of lemmas
@@ -131,9 +156,6 @@ class Annotator:
         sentences = self.sent_tokenizer.tokenize(fulltext)
         for sentence in sentences:
             doc = self.tokenizer.tokenize(sentence)
-            tokens += [
-                [
-                    self.token_func(t, None) for t in doc
-                ]  # if t not in string.punctuation + "\n"]
-            ]
+            # if t not in string.punctuation + "\n"]
+            tokens += [stem_many(self.func_name, doc)]
         return tokens
@@ -1,13 +1,123 @@
-from sqlalchemy import create_engine  # type: ignore
+from typing import AsyncIterator, Iterator, Optional
+
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import create_engine, exc  # type: ignore
 from sqlalchemy.ext.declarative import declarative_base  # type: ignore
 from sqlalchemy.orm import sessionmaker  # type: ignore
+from sqlalchemy.pool import QueuePool  # type: ignore
+from starlette.concurrency import run_in_threadpool  # type: ignore
 
 from settings import DATABASE_URL  # , DEBUG
 
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that measures how long checkouts wait for a connection, see pool_stats()"""
+
+    def __init__(self, *args, max_overflow: int = 10, **kwargs):
+        super().__init__(*args, max_overflow=max_overflow, **kwargs)
+        # QueuePool keeps it private
+        self.max_overflow = max_overflow
+        self.stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self.stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            with self.stats_lock:
+                self.checkouts += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+
+
 # DEBUG = True
 DEBUG = False
-engine = create_engine(DATABASE_URL, echo=DEBUG, pool_size=10, max_overflow=20)
+# SQLite does not pool connections
+pool_args = (
+    {}
+    if DATABASE_URL.startswith("sqlite")
+    else {"poolclass": InstrumentedQueuePool, "pool_size": 10, "max_overflow": 20}
+)
+engine = create_engine(DATABASE_URL, echo=DEBUG, **pool_args)
 # engine = create_engine(DATABASE_URL, echo=DEBUG)
 Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
+
+current_session: ContextVar[Optional[Session]] = ContextVar(
+    "current_session", default=None
+)
+"""Session of the request being served, see get_session()"""
+
+
+@contextmanager
+def session_scope() -> Iterator[Session]:
+    """The session of the current request if any, see get_session(),
+    otherwise a new session committed and closed on exit, e.g. for CLI scripts"""
+    s = current_session.get()
+    if s is not None:
+        yield s
+        return
+    s = Session()
+    try:
+        yield s
+        s.commit()
+    except BaseException:
+        s.rollback()
+        raise
+    finally:
+        s.close()
+
+
+async def get_session() -> AsyncIterator[Session]:
+    """FastAPI dependency: a session per request, closed once the request is served.
+    Code running for the request gets it through session_scope().
+    Async, or endpoints would not see current_session: commit and close run in the threadpool"""
+    s = Session()
+    token = current_session.set(s)
+    try:
+        yield s
+        await run_in_threadpool(s.commit)
+    except BaseException:
+        await run_in_threadpool(s.rollback)
+        raise
+    finally:
+        current_session.reset(token)
+        await run_in_threadpool(s.close)
+
+
+def pool_stats() -> dict[str, object]:
+    """Connection pool usage, to size pool_size and max_overflow"""
+    pool = engine.pool
+    stats: dict[str, object] = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            # negative while the pool is not full yet
+            overflow=max(pool.overflow(), 0),
+        )
+    if isinstance(pool, InstrumentedQueuePool):
+        with pool.stats_lock:
+            stats.update(
+                max_overflow=pool.max_overflow,
+                checkouts=pool.checkouts,
+                timeouts=pool.timeouts,
+                wait_avg_ms=1000 * pool.wait_total / max(pool.checkouts, 1),
+                wait_max_ms=1000 * pool.wait_max,
+            )
+    return stats
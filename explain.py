@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""Index advisor: runs the query plan of each function in query.py
+and flags sequential scans on large tables.
+The statements are captured while the functions run, then explained one by one:
+EXPLAIN ANALYZE on PostgreSQL, EXPLAIN QUERY PLAN elsewhere.
+
+Usage:
+  explain.py [--stemmer=<stemmer>] [--min-rows=<n>] [--plans]
+
+Options:
+  -h --help             This information
+  -s --stemmer=<name>   Stemmer passed to the queries [default: dummy]
+  -m --min-rows=<n>     Tables with fewer rows are fine to scan [default: 10000]
+  -p --plans            Print the full plans, not only the flagged scans
+"""
+
+from typing import Callable
+
+import re
+
+from docopt import docopt  # type: ignore
+from sqlalchemy import event, inspect, text  # type: ignore
+
+from db import Session, engine, session_scope
+import query
+
+ExplainedQuery = tuple[str, Callable[[Session, str], object]]
+
+explained: list[ExplainedQuery] = [
+    ("tokenize_values", lambda s, stemmer: query.tokenize_values(s, stemmer)),
+    ("flat_tokenize_values", lambda s, stemmer: query.flat_tokenize_values(s, stemmer)),
+    ("load_source", lambda s, stemmer: query.load_source(s, stemmer)),
+    ("calc_occurences", lambda s, stemmer: query.calc_occurences(s, stemmer)),
+    (
+        "calc_occurences flat",
+        lambda s, stemmer: query.calc_occurences(s, stemmer, flat=True),
+    ),
+    (
+        "calc_occurences aggregated",
+        lambda s, stemmer: query.calc_occurences(s, stemmer, aggregated=True),
+    ),
+    ("get_stemmer2vocab", lambda s, stemmer: query.get_stemmer2vocab(s)),
+    ("corpora_stats", lambda s, stemmer: query.corpora_stats(s)),
+    ("corpora_token_counts", lambda s, stemmer: query.corpora_token_counts(s)),
+]
+
+# "Seq Scan on words" (PostgreSQL), "SCAN words" or "SCAN TABLE words" (SQLite)
+seq_scan = re.compile(r"(?:Seq Scan on|^\W*SCAN(?: TABLE)?) (\w+)")
+
+
+def capture(s: Session, func: Callable[[Session, str], object], stemmer: str):
+    """The distinct statements, with their first parameters, that func executes"""
+    statements: dict[str, object] = {}
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        statements.setdefault(statement, parameters)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        func(s, stemmer)
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    return statements.items()
+
+
+def plan(s: Session, statement: str, parameters) -> list[str]:
+    conn = s.connection()
+    if conn.dialect.name == "postgresql":
+        rows = conn.exec_driver_sql(f"EXPLAIN ANALYZE {statement}", parameters)
+        return [line for line, in rows]
+    rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)
+    return [row[-1] for row in rows]
+
+
+def table_sizes(s: Session) -> dict[str, int]:
+    """Row counts, partitions included"""
+    return {
+        table: s.execute(text(f'SELECT COUNT(*) FROM "{table}"')).scalar()
+        for table in inspect(s.connection()).get_table_names()
+    }
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    stemmer = args["--stemmer"]
+    min_rows = int(args["--min-rows"])
+
+    with session_scope() as s:
+        sizes = table_sizes(s)
+        flagged = 0
+        for name, func in explained:
+            for statement, parameters in capture(s, func, stemmer):
+                lines = plan(s, statement, parameters)
+                scans = [
+                    (line.strip(), table)
+                    for line in lines
+                    for table in seq_scan.findall(line)
+                    if sizes.get(table, 0) >= min_rows
+                ]
+                flagged += len(scans)
+                status = "SEQ SCAN" if scans else "ok"
+                print(f">>> {name}: {status}")
+                if args["--plans"]:
+                    print("\n".join(lines))
+                for line, table in scans:
+                    print(f"    {table} ({sizes[table]} rows): {line}")
+        s.rollback()
+    print(f">>> {flagged} sequential scans on tables of {min_rows}+ rows")
+    exit(1 if flagged else 0)
@@ -2,21 +2,11 @@
 """Generate a heatmap of texts/stories vs labels"""
 from typing import Dict, List, Tuple
 
-import pandas as pd  # type: ignore
-
 from settings import CLEAN_THRESHOLD, VOCAB
 
 from corpora import corpora, country2code
-from stemmers import stemmers
-from palettes import pal_seq
 
 from util import fname2name, fname2path
-from persistence import tokenize_values, load_source, calc_occurences
-
-from bokeh.models import LinearColorMapper, LabelSet, ColumnDataSource, TapTool, OpenURL  # type: ignore
-from bokeh.plotting import figure  # type: ignore
-from bokeh.resources import CDN  # type: ignore
-from bokeh.embed import file_html  # type: ignore
 
 
 def render(tkn: str, flat: bool = False, aggregated=False) -> str:
@@ -27,7 +17,30 @@ def render(tkn: str, flat: bool = False, aggregated=False) -> str:
         flat (bool): aggregate tokens by values
         aggregated (bool): aggregate texts by corpora
     """
+    # imported here, the worker processes running plot() need no database
+    from persistence import calc_occurences
+
     occurences, _, occurences_backref = calc_occurences(tkn, flat, aggregated)
+    return plot(tkn, occurences, occurences_backref, flat, aggregated)
+
+
+def plot(
+    tkn: str,
+    occurences: Dict[Tuple[str, str], int],
+    occurences_backref: Dict[str, Dict[str, int]],
+    flat: bool = False,
+    aggregated=False,
+) -> str:
+    """The heatmap of occurrences, see persistence.calc_occurences().
+    Takes no database access, so that it runs in a worker process, see workers.py"""
+    # imported here, pandas and bokeh would slow down the startup of main.py
+    import pandas as pd  # type: ignore
+    from bokeh.models import LinearColorMapper, LabelSet, ColumnDataSource, TapTool, OpenURL  # type: ignore
+    from bokeh.plotting import figure  # type: ignore
+    from bokeh.resources import CDN  # type: ignore
+    from bokeh.embed import file_html  # type: ignore
+
+    from palettes import pal_seq
 
     interactive = "" if aggregated else "Clickable "
     xaxis = "Labels" if flat else "Values"
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Import-time profile of a module, as reported by `python -X importtime`.
+Lists the packages that take longest to import and fails when the module imports
+any of the forbidden packages, so that a heavy import moved back to module level
+is noticed before it slows down every worker boot and reload of main.py.
+Packages are checked rather than milliseconds, which depend on the machine.
+
+Usage:
+  importtime.py [--forbid=<packages>] [--top=<n>] [<module>]
+
+Options:
+  -h --help             This information
+  -f --forbid=<packages>  Packages the module must not import, comma separated
+                        [default: bokeh,pandas,gensim,networkx,nltk,colorcet]
+  -t --top=<n>          Number of packages listed [default: 15]
+"""
+
+import re
+import sys
+import subprocess
+
+from docopt import docopt  # type: ignore
+
+line_re = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+Timing = tuple[int, int, int, str]
+"""self and cumulative time in us, nesting level and module"""
+
+
+def profile(module: str) -> list[Timing]:
+    """The timings of a fresh interpreter importing the module"""
+    run = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    if run.returncode:
+        raise RuntimeError(run.stderr.strip().splitlines()[-1])
+    timings = []
+    for line in run.stderr.splitlines():
+        found = line_re.match(line)
+        if found:
+            own, cumulative, indent, name = found.groups()
+            timings += [(int(own), int(cumulative), len(indent) // 2, name)]
+    return timings
+
+
+def total(timings: list[Timing], module: str) -> int:
+    """The cumulative import time of the module, in us"""
+    return next(cum for _, cum, level, name in timings if level == 0 and name == module)
+
+
+def by_package(timings: list[Timing]) -> dict[str, int]:
+    """Own import time of each top-level package with its submodules, in us"""
+    packages: dict[str, int] = {}
+    for own, _, _, name in timings:
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + own
+    return packages
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    module = args["<module>"] or "main"
+
+    timings = profile(module)
+    packages = by_package(timings)
+    print(f"{'package':<30} {'ms':>8}")
+    for package in sorted(packages, key=lambda p: -packages[p])[: int(args["--top"])]:
+        print(f"{package:<30} {packages[package] / 1000:>8.1f}")
+    print(f"{'import ' + module:<30} {total(timings, module) / 1000:>8.1f}")
+
+    forbidden = [p for p in args["--forbid"].split(",") if p in packages]
+    if forbidden:
+        print(
+            f">>> {module} imports {', '.join(forbidden)}, to be imported at first use"
+        )
+        exit(1)
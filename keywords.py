@@ -2,14 +2,11 @@ from typing import Dict, Iterable, List, Set, Tuple
 
 import itertools
 
-import networkx as nx  # type: ignore
-from networkx.algorithms import community  # type: ignore
-
 from settings import model_dir, CLEAN_THRESHOLD
 
 from stemmers import stemmers
 from corpora import corpora
-from algo import algos
+from vectors import vectors
 from template import venn_templ, tspan_templ, value_link_templ
 
 from persistence import tokenize_values, load_source, calc_occurences
@@ -182,9 +179,13 @@ def clusters(
     Returns:
         Dict[str, List[List[str]]]: corpus -> list of clusters
     """
+    # imported here, networkx would slow down the startup of main.py
+    import networkx as nx  # type: ignore
+    from networkx.algorithms import community  # type: ignore
+
     try:
         models = {
-            c: algos[algo].load(f"{model_dir}/{c}.{tkn}.e{epochs}.{algo}.{iteration}")
+            c: vectors(f"{model_dir}/{c}.{tkn}.e{epochs}.{algo}.{iteration}", algo)
             for c in corpora
         }
     except FileNotFoundError as fnfe:
@@ -213,7 +214,7 @@ def clusters(
                 if k not in ckeywords[c] or x not in ckeywords[c]:
                     continue
                 try:
-                    sim = m.wv.similarity(k, x)
+                    sim = m.similarity(k, x)
                     if sim >= threshold:
                         G[c].add_edge(k, x, weight=float(sim))
                 except KeyError:
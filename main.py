@@ -2,8 +2,13 @@
 """A dynamic service for moreever. See https://github.com/umilISLab/moreever/ for details."""
 from typing import Any
 
-from fastapi import FastAPI, HTTPException
+import re
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, HTTPException, Depends
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import Response, HTMLResponse, RedirectResponse
+from fastapi.responses import StreamingResponse
 from fastapi.requests import Request
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
@@ -14,16 +19,20 @@ from stemmers import stemmers
 from template import list_templ
 
 from util import save_vocab
-from persistence import tokenize_values, load_source, calc_occurences
-from pages import index_html, page_corpus_html
+from persistence import tokenize_values, load_source, calc_occurences, refresh_vocab
+from pages import index_html, iter_corpus_html, page_text_html
 from pages import text_anchor_html
 from pages import edit_vocab_html, values_html, value_list_html
 from pages import values_css
 from pages import stats_html
 from keywords import keywords_venn, clusters, render_venn, filter_clusters_containing
-from heatmap import render as heatmap_render
+from heatmap import plot as heatmap_plot
 
-from settings import DEBUG
+from db import get_session, pool_stats
+from vectors import vectors_stats
+from workers import run_in_process, shutdown as shutdown_workers
+from cache import CachedResponses, ResponseCache
+from settings import DEBUG, CACHE_MB, CACHE_SPILL_DIR, CACHE_SPILL_MB
 
 
 class CSSResponse(Response):
@@ -34,13 +43,38 @@ class SVGResponse(Response):
     media_type = "image/svg+xml"
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    shutdown_workers()
+
+
 app = FastAPI(
+    lifespan=lifespan,
     title="moreever",
     description=__doc__,
     # docs_url="/",
     version="0.2.0",
+    # one session per request, see persistence.py
+    dependencies=[Depends(get_session)],
 )
 
+# Pages that only depend on their path and on the data, see cache.py
+cached_pages = [
+    r"/(index\.html)?",
+    r"/[^/]+/[^/]+/values\.(html|css)",
+    r"/[^/]+/[^/]+/map(-condensed)?\.html",
+    r"/[^/]+/[^/]+/keywords\.svg",
+    r"/[^/]+/[^/]+/([^/]+/)?index\.html",
+    r"/[^/]+/[^/]+/(%s)(/[^/]+)?\.html" % "|".join(re.escape(c) for c in corpora),
+]
+
+# added first, so that CORS headers are added to cached pages too
+app.add_middleware(
+    CachedResponses,
+    paths=cached_pages,
+    cache=ResponseCache(CACHE_MB * 2**20, CACHE_SPILL_DIR, CACHE_SPILL_MB * 2**20),
+)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -49,33 +83,36 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Routes that query the database or read files are plain functions, FastAPI runs
+# them in its thread pool so the event loop stays free, see also workers.py
+
 
 @app.get("/{stemmer}/{vocab}/values.css", response_class=CSSResponse)
-async def values_css_page(vocab: str, stemmer: str):
+def values_css_page(vocab: str, stemmer: str):
     """The CSS providing the coloring for the vocabulary."""
     return values_css(stemmer, vocab)
 
 
 @app.get("/{stemmer}/{vocab}/values.html", response_class=HTMLResponse)
-async def values_page(vocab: str, stemmer: str):
+def values_page(vocab: str, stemmer: str):
     """The coloured vocabularly."""
     return values_html(stemmer, vocab)
 
 
 @app.get("/{stemmer}/{vocab}/values-edit.html", response_class=HTMLResponse)
-async def values_edit_page(vocab: str, stemmer: str):
+def values_edit_page(vocab: str, stemmer: str):
     """The editable vocabularly."""
     return edit_vocab_html(stemmer, vocab)
 
 
 @app.get("/{stemmer}/{vocab}/keywords.svg", response_class=SVGResponse)
-async def keywords_venn_page(vocab: str, stemmer: str):
+def keywords_venn_page(vocab: str, stemmer: str):
     """The Venn diagram with the vocabulary"""
     return keywords_venn(stemmer, f"{vocab}.flat")
 
 
 @app.get("/{stemmer}/{vocab}/cluster-{value}.svg", response_class=SVGResponse)
-async def cluster_venn_page(vocab: str, stemmer: str, value: str):
+def cluster_venn_page(vocab: str, stemmer: str, value: str):
     """The Venn diagram with the word vectors"""
     values, _ = tokenize_values(stemmer)
     # _, tokenized = load_source(stemmer, corpora)
@@ -95,20 +132,24 @@ async def cluster_venn_page(vocab: str, stemmer: str, value: str):
 @app.get("/{stemmer}/{vocab}/map.html", response_class=HTMLResponse)
 async def heatmap_page(stemmer: str, vocab: str):
     """The Heatmap with texts vs labels"""
-    return heatmap_render(stemmer, True)
+    occurences, _, backref = await run_in_threadpool(calc_occurences, stemmer, True)
+    return await run_in_process(heatmap_plot, stemmer, occurences, backref, True)
 
 
 @app.get("/{stemmer}/{vocab}/map-condensed.html", response_class=HTMLResponse)
 async def heatmap_page(stemmer: str, vocab: str):
     """The Heatmap with texts vs labels"""
-    return heatmap_render(stemmer, aggregated=True)
+    occurences, _, backref = await run_in_threadpool(
+        calc_occurences, stemmer, False, True
+    )
+    return await run_in_process(heatmap_plot, stemmer, occurences, backref, False, True)
 
 
 # @app.get("/{stemmer}", response_class=HTMLResponse)
 @app.get("/{stemmer}/{vocab}/index.html", response_class=HTMLResponse)
 # @app.get("/{stemmer}", response_class=HTMLResponse)
 @app.get("/{stemmer}/{vocab}/{corpus}/index.html", response_class=HTMLResponse)
-async def values_index(stemmer: str, vocab: str, corpus: str = ""):
+def values_index(stemmer: str, vocab: str, corpus: str = ""):
     """The list of texts in the corpus (or in all corpora if corpus unspecified)"""
     # print(corpus)
     if corpus:
@@ -127,7 +168,7 @@ async def values_index(stemmer: str, vocab: str, corpus: str = ""):
 
 @app.get("/{stemmer}/{vocab}/values/{label}.html", response_class=HTMLResponse)
 @app.get("/{stemmer}/{vocab}/{corpus}/values/{label}.html", response_class=HTMLResponse)
-async def value_list_page(stemmer: str, vocab: str, label: str, corpus: str = ""):
+def value_list_page(stemmer: str, vocab: str, label: str, corpus: str = ""):
     """The list of texts that contain a specific label/token"""
     if corpus:
         if corpus not in corpora:
@@ -162,18 +203,47 @@ async def value_list_page(stemmer: str, vocab: str, label: str, corpus: str = ""
 
 
 @app.get("/{stemmer}/{vocab}/{corpus}.html", response_class=HTMLResponse)
-async def page_corpus(stemmer: str, vocab: str, corpus: str):
+def page_corpus(stemmer: str, vocab: str, corpus: str):
+    """All the texts of a corpus, streamed a text at a time"""
     _, values_br = tokenize_values(stemmer)
-    return page_corpus_html(corpus, stemmer, vocab, values_br)
+    return StreamingResponse(
+        iter_corpus_html(corpus, stemmer, vocab, values_br), media_type="text/html"
+    )
+
+
+@app.get("/{stemmer}/{vocab}/{corpus}/{text}.html", response_class=HTMLResponse)
+def page_text(stemmer: str, vocab: str, corpus: str, text: str):
+    """A single text of a corpus, {corpus}.html#{text} on its own"""
+    if corpus not in corpora:
+        raise HTTPException(status_code=404, detail=f"Corpus not found for {corpus}")
+    _, values_br = tokenize_values(stemmer)
+    page = page_text_html(corpus, stemmer, vocab, text, values_br)
+    if page is None:
+        raise HTTPException(
+            status_code=404, detail=f"Text not found for {text} in {corpus}"
+        )
+    return page
 
 
 @app.get("/stats.html", response_class=HTMLResponse)
-async def stats():
+def stats():
     return stats_html()
 
 
+@app.get("/pool")
+async def pool():
+    """Connection pool usage, to size pool_size and max_overflow in db.py"""
+    return pool_stats()
+
+
+@app.get("/vectors")
+async def vectors_usage():
+    """Word vectors loaded and reused, to size VECTORS_MB in settings.py"""
+    return vectors_stats()
+
+
 @app.get("/vocab")
-async def saveVocab(request: Request):
+def saveVocab(request: Request):
     # async with request.form() as form:
     form = request.query_params
     vocab = form["vocab"]
@@ -181,6 +251,7 @@ async def saveVocab(request: Request):
 
     if "contents" in form:
         save_vocab(form["contents"], vocab)
+        refresh_vocab(vocab)
         return RedirectResponse("/reload.html", status_code=status.HTTP_302_FOUND)
     else:
         return RedirectResponse(
@@ -191,7 +262,7 @@ async def saveVocab(request: Request):
 
 @app.get("/", response_class=HTMLResponse)
 @app.get("/index.html", response_class=HTMLResponse)
-async def index():
+def index():
     return index_html()
 
 
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""Versioned schema migrations, so that existing databases can be upgraded in place.
+A new database is created at the latest version, an existing one gets the pending
+migrations applied in order and recorded in schema_version.
+To add a migration append a function to `migrations`, never edit or reorder them.
+
+Usage:
+  migrations.py [--status]
+
+Options:
+  -h --help             This information
+  -s --status           Print the schema version without migrating
+"""
+
+from typing import Callable, Union
+
+import re
+
+from docopt import docopt  # type: ignore
+from sqlalchemy import func, inspect, select, text, LargeBinary  # type: ignore
+from sqlalchemy.engine import Connection, Engine  # type: ignore
+
+from db import Base, Session, engine
+from model import Token, Text, Sentence, Word, Stem, Occurrence, Form, Lexicon, Posting
+from model import CorpusStats, StemmerStats, SchemaVersion
+from query import link_lexicon, refresh_stats
+
+Bind = Union[Session, Connection]
+
+
+def is_partitioned(s: Bind) -> bool:
+    """Whether per-stemmer tables are partitioned, see model.Stem"""
+    bind = s if isinstance(s, Connection) else s.get_bind()
+    return bind.dialect.name == "postgresql"
+
+
+def partition_name(table: str, stemmer: str) -> str:
+    suffix = re.sub(r"\W", "_", stemmer)
+    return f"{table}_{suffix}"
+
+
+def create_partition(s: Bind, stemmer: str) -> None:
+    """Creates the partition of stems for a stemmer seen for the first time"""
+    if not is_partitioned(s):
+        return
+    table = Stem.__tablename__
+    value = stemmer.replace("'", "''")
+    s.execute(
+        text(
+            f"CREATE TABLE IF NOT EXISTS {partition_name(table, stemmer)}"
+            f" PARTITION OF {table} FOR VALUES IN ('{value}')"
+        )
+    )
+
+
+def columns(conn: Connection, table: str) -> list[str]:
+    return [c["name"] for c in inspect(conn).get_columns(table)]
+
+
+def add_content_hash(conn: Connection) -> None:
+    """texts.content_hash for incremental ingestion"""
+    if "content_hash" not in columns(conn, "texts"):
+        conn.execute(text("ALTER TABLE texts ADD COLUMN content_hash VARCHAR"))
+
+
+def share_words(conn: Connection) -> None:
+    """words shared by all stemmers, tokens moved to stems"""
+    if "stemmer" not in columns(conn, "words"):
+        return
+    Stem.__table__.create(conn, checkfirst=True)
+    stemmers = conn.execute(text("SELECT DISTINCT stemmer FROM words"))
+    for stemmer in stemmers.scalars().all():
+        create_partition(conn, stemmer)
+    conn.execute(text("""INSERT INTO stems (stemmer, word, token)
+            SELECT stemmer, word, MIN(token) FROM words GROUP BY stemmer, word"""))
+    # texts were stored once per stemmer, the first copy is kept
+    kept = "SELECT MIN(id) FROM texts GROUP BY corpus, fname"
+    conn.execute(text(f"""DELETE FROM words WHERE sentence_id IN (
+                SELECT id FROM sentences WHERE text_id NOT IN ({kept}))"""))
+    conn.execute(text(f"DELETE FROM sentences WHERE text_id NOT IN ({kept})"))
+    conn.execute(text(f"DELETE FROM texts WHERE id NOT IN ({kept})"))
+    conn.execute(text("ALTER TABLE words DROP COLUMN token"))
+    conn.execute(text("ALTER TABLE words DROP COLUMN stemmer"))
+
+
+def key_stems(conn: Connection) -> None:
+    """stems keyed by (stemmer, word), list-partitioned on PostgreSQL"""
+    if "id" not in columns(conn, "stems"):
+        return
+    conn.execute(text("ALTER TABLE stems RENAME TO stems_unkeyed"))
+    if is_partitioned(conn):
+        # index names are per schema on PostgreSQL
+        conn.execute(text("ALTER INDEX stems_pkey RENAME TO stems_unkeyed_pkey"))
+    Stem.__table__.create(conn)
+    stemmers = conn.execute(text("SELECT DISTINCT stemmer FROM stems_unkeyed"))
+    for stemmer in stemmers.scalars().all():
+        create_partition(conn, stemmer)
+    conn.execute(text("""INSERT INTO stems (timestamp, stemmer, word, token)
+            SELECT timestamp, stemmer, word, token FROM stems_unkeyed"""))
+    conn.execute(text("DROP TABLE stems_unkeyed"))
+
+
+def create_indexes(conn: Connection, names: list[str]) -> None:
+    """Creates the indexes declared in model.py with the given names"""
+    indexes = {
+        index.name: index
+        for table in Base.metadata.tables.values()
+        for index in table.indexes
+    }
+    for name in names:
+        indexes[name].create(conn, checkfirst=True)
+
+
+def add_indexes(conn: Connection) -> None:
+    """indexes on the join and filter columns of query.py"""
+    for model in (Token, Text, Sentence, Word, Stem):
+        # indexes on columns added since are created by their own migration
+        existing = columns(conn, model.__tablename__)
+        for index in model.__table__.indexes:
+            if all(column.name in existing for column in index.columns):
+                index.create(conn, checkfirst=True)
+
+
+def add_occurrences(conn: Connection) -> None:
+    """occurrences precomputed per stemmer, text and token"""
+    Occurrence.__table__.create(conn, checkfirst=True)
+    # the schema of this version, words are joined to stems on the word itself
+    conn.execute(text("""INSERT INTO occurrences
+                (stemmer, corpus, text_id, name, token, token_class, count)
+            SELECT stems.stemmer, texts.corpus, texts.id, texts.name,
+                tokens.token, tokens.token_class, COUNT(words.id)
+            FROM texts
+            JOIN sentences ON sentences.text_id = texts.id
+            JOIN words ON words.sentence_id = sentences.id
+            JOIN stems ON stems.word = words.word
+            JOIN (SELECT DISTINCT stemmer, token, token_class FROM tokens) AS tokens
+                ON tokens.stemmer = stems.stemmer AND tokens.token = stems.token
+            GROUP BY stems.stemmer, texts.corpus, texts.id, texts.name,
+                tokens.token, tokens.token_class"""))
+
+
+def add_lexicon(conn: Connection) -> None:
+    """integer ids to join words, stems and tokens on"""
+    for table, column in [
+        ("words", "form_id"),
+        ("stems", "form_id"),
+        ("stems", "token_id"),
+        ("tokens", "token_id"),
+    ]:
+        if column not in columns(conn, table):
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} INTEGER"))
+    Form.__table__.create(conn, checkfirst=True)
+    Lexicon.__table__.create(conn, checkfirst=True)
+    create_indexes(conn, ["ix_tokens_token_id", "ix_stems_stemmer_form_id"])
+    # superseded by words.form_id
+    conn.execute(text("DROP INDEX IF EXISTS ix_words_word"))
+    link_lexicon(conn)
+
+
+def add_arrays(conn: Connection) -> None:
+    """sentence arrays and postings for arrays storage"""
+    if "forms" not in columns(conn, "sentences"):
+        binary = LargeBinary().compile(dialect=conn.dialect)
+        conn.execute(text(f"ALTER TABLE sentences ADD COLUMN forms {binary}"))
+    Posting.__table__.create(conn, checkfirst=True)
+
+
+def add_stats(conn: Connection) -> None:
+    """statistics of stats.html precomputed"""
+    CorpusStats.__table__.create(conn, checkfirst=True)
+    StemmerStats.__table__.create(conn, checkfirst=True)
+    # counted where the words are, whatever the STORAGE of this process
+    postings = conn.execute(select(Posting.form_id).limit(1)).first()
+    with Session(bind=conn) as s:
+        refresh_stats(s, "arrays" if postings else "rows")
+        s.commit()
+
+
+def add_annotations_index(conn: Connection) -> None:
+    """annotations looked up per stemmer and text"""
+    # filled by the next populate.py, pages annotate the missing ones meanwhile
+    create_indexes(conn, ["ix_annotations_stemmer_text_id"])
+
+
+def add_offsets(conn: Connection) -> None:
+    """character offsets of sentences and words, to annotate without tokenizing"""
+    # filled by populate.py, texts without them are tokenized when annotated
+    binary = LargeBinary().compile(dialect=conn.dialect)
+    for table, column, kind in [
+        ("sentences", "char_start", "INTEGER"),
+        ("sentences", "char_end", "INTEGER"),
+        ("sentences", "offsets", binary),
+        ("words", "char_start", "INTEGER"),
+        ("words", "char_end", "INTEGER"),
+    ]:
+        if column not in columns(conn, table):
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {kind}"))
+
+
+def add_annotated_titles(conn: Connection) -> None:
+    """annotated names of the texts, stored with their annotations"""
+    # filled by the next populate.py, pages annotate the missing ones meanwhile
+    if "title" not in columns(conn, "annotations"):
+        conn.execute(text("ALTER TABLE annotations ADD COLUMN title VARCHAR"))
+
+
+migrations: list[Callable[[Connection], None]] = [
+    add_content_hash,
+    share_words,
+    key_stems,
+    add_indexes,
+    add_occurrences,
+    add_lexicon,
+    add_arrays,
+    add_stats,
+    add_annotations_index,
+    add_offsets,
+    add_annotated_titles,
+]
+"""Version n of the schema is reached by applying migrations[n-1]"""
+
+
+def current_version(conn: Connection) -> int:
+    SchemaVersion.__table__.create(conn, checkfirst=True)
+    return conn.execute(select(func.max(SchemaVersion.version))).scalar() or 0
+
+
+def stamp(conn: Connection, version: int) -> None:
+    conn.execute(SchemaVersion.__table__.insert().values(version=version))
+
+
+def migrate(engine: Engine = engine) -> int:
+    """Brings the database to the latest version, creating it when empty.
+    Each migration runs in its own transaction.
+
+    Returns:
+        int: the number of migrations applied
+    """
+    with engine.begin() as conn:
+        if not inspect(conn).has_table(Text.__tablename__):
+            Base.metadata.create_all(conn)
+            stamp(conn, len(migrations))
+            return 0
+        version = current_version(conn)
+    for i, migration in enumerate(migrations[version:], version + 1):
+        print(f">>> MIGRATING to version {i}: {migration.__doc__}")
+        with engine.begin() as conn:
+            migration(conn)
+            stamp(conn, i)
+    # tables introduced since
+    Base.metadata.create_all(engine)
+    return len(migrations) - version
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+
+    if args["--status"]:
+        with engine.connect() as conn:
+            print(f"Schema version {current_version(conn)} of {len(migrations)}")
+        exit(0)
+
+    applied = migrate()
+    print(f">>> {applied} migrations applied, schema version {len(migrations)}")
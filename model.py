@@ -1,5 +1,5 @@
-from sqlalchemy import Column, Computed  # type: ignore
-from sqlalchemy import Integer, String, DateTime  # type: ignore
+from sqlalchemy import Column, Computed, Index, UniqueConstraint  # type: ignore
+from sqlalchemy import Integer, String, DateTime, LargeBinary  # type: ignore
 from sqlalchemy.sql import func  # type: ignore
 from sqlalchemy.orm import relationship  # type: ignore
 
@@ -17,6 +17,12 @@ class Token(Base):
     token = Column(String, nullable=False)
     stemmer = Column(String, nullable=False)
     token_class = Column(String, nullable=False)
+    token_id = Column(Integer, comment="See Lexicon")
+
+    __table_args__ = (
+        Index("ix_tokens_stemmer_token", "stemmer", "token"),
+        Index("ix_tokens_token_id", "token_id"),
+    )
 
 
 class Text(Base):
@@ -29,6 +35,9 @@ class Text(Base):
     fname = Column(String, nullable=False)
     corpus = Column(String, nullable=False)
     fulltext = Column(String, nullable=False)
+    content_hash = Column(String, comment="sha256 of fulltext, see util.content_hash")
+
+    __table_args__ = (Index("ix_texts_corpus_name", "corpus", "name"),)
 
 
 class Sentence(Base):
@@ -39,14 +48,26 @@ class Sentence(Base):
     id = Column(Integer, primary_key=True)
     timestamp = Column(DateTime, server_default=func.now())
 
-    sentence = Column(String, nullable=False)
+    sentence = Column(String, nullable=False, comment="Empty with arrays storage")
     order = Column(Integer, nullable=False)
     text_id = Column(Integer, nullable=False)
     # stemmer = Column(String, nullable=False)
+    forms = Column(
+        LargeBinary,
+        comment="Form ids of the words with arrays storage, see util.pack_ids",
+    )
+    char_start = Column(Integer, comment="Offset in the cleaned fulltext")
+    char_end = Column(Integer)
+    offsets = Column(
+        LargeBinary,
+        comment="Start and end offset of each word with arrays storage, see util.pack_ids",
+    )
+
+    __table_args__ = (Index("ix_sentences_text_id_order", "text_id", "order"),)
 
 
 class Word(Base):
-    """Tokenized words in a sentence"""
+    """Tokenized words in a sentence, shared by all stemmers"""
 
     __tablename__ = "words"
 
@@ -54,13 +75,129 @@ class Word(Base):
     timestamp = Column(DateTime, server_default=func.now())
 
     word = Column(String, nullable=False, comment="Word as originally present")
-    token = Column(String, nullable=False, comment="Actually token")
     order = Column(Integer, nullable=False)
     sentence_id = Column(Integer, nullable=False)
+    form_id = Column(Integer, comment="See Form")
+    char_start = Column(Integer, comment="Offset in the cleaned fulltext")
+    char_end = Column(Integer)
+
+    __table_args__ = (Index("ix_words_sentence_id_order", "sentence_id", "order"),)
+
+
+class Stem(Base):
+    """Token of each distinct word, per stemmer.
+    On PostgreSQL the table is list-partitioned by stemmer, see migrations.create_partition()
+    """
+
+    __tablename__ = "stems"
+    __table_args__ = (
+        Index("ix_stems_stemmer_token", "stemmer", "token"),
+        Index("ix_stems_stemmer_form_id", "stemmer", "form_id"),
+        {"postgresql_partition_by": "LIST (stemmer)"},
+    )
+
+    timestamp = Column(DateTime, server_default=func.now())
+
+    stemmer = Column(String, primary_key=True)
+    word = Column(String, primary_key=True, comment="Word as originally present")
+    token = Column(String, nullable=False, comment="Actually token")
+    form_id = Column(Integer, comment="See Form")
+    token_id = Column(Integer, comment="See Lexicon")
+
+
+class Form(Base):
+    """Distinct words, so that words and stems join on integers.
+    Ids are assigned after ingestion, see query.link_lexicon()"""
+
+    __tablename__ = "forms"
+
+    id = Column(Integer, primary_key=True)
+
+    word = Column(String, nullable=False, unique=True)
+
+
+class Lexicon(Base):
+    """Distinct tokens per stemmer, so that stems and tokens join on integers.
+    Ids are assigned after ingestion, see query.link_lexicon()"""
+
+    __tablename__ = "lexicon"
+
+    id = Column(Integer, primary_key=True)
+
     stemmer = Column(String, nullable=False)
+    token = Column(String, nullable=False)
+
+    __table_args__ = (UniqueConstraint("stemmer", "token"),)
+
+
+class Posting(Base):
+    """Positional inverted index of the sentences with arrays storage,
+    which take the place of words there, see settings.STORAGE"""
+
+    __tablename__ = "postings"
+
+    form_id = Column(Integer, primary_key=True)
+    sentence_id = Column(Integer, primary_key=True)
+    positions = Column(LargeBinary, nullable=False, comment="See util.pack_ids")
+    freq = Column(Integer, nullable=False)
+
+    __table_args__ = (Index("ix_postings_sentence_id", "sentence_id"),)
+
+
+class Occurrence(Base):
+    """Occurrences of each vocabulary token in each text, per stemmer.
+    Derived from the tables above, see query.refresh_occurrences()"""
+
+    __tablename__ = "occurrences"
+
+    id = Column(Integer, primary_key=True)
+    timestamp = Column(DateTime, server_default=func.now())
+
+    stemmer = Column(String, nullable=False)
+    corpus = Column(String, nullable=False)
+    text_id = Column(Integer, nullable=False)
+    name = Column(String, nullable=False, comment="Name of the text")
+    token = Column(String, nullable=False)
+    token_class = Column(String, nullable=False)
+    count = Column(Integer, nullable=False)
+
+    __table_args__ = (Index("ix_occurrences_stemmer_corpus", "stemmer", "corpus"),)
+
+
+class CorpusStats(Base):
+    """Counts per corpus shown by stats.html, see query.refresh_stats()"""
+
+    __tablename__ = "corpus_stats"
+
+    corpus = Column(String, primary_key=True)
+    texts = Column(Integer, nullable=False)
+    sentences = Column(Integer, nullable=False)
+    words = Column(Integer, nullable=False)
+    tokens = Column(Integer, nullable=False, comment="Distinct vocabulary tokens found")
+
+
+class StemmerStats(Base):
+    """Words per stemmer and value shown by stats.html, see query.refresh_stats()"""
+
+    __tablename__ = "stemmer_stats"
+
+    stemmer = Column(String, primary_key=True)
+    token_class = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False)
+
+
+class SchemaVersion(Base):
+    """Migrations applied to the database, see migrations.py"""
+
+    __tablename__ = "schema_version"
+
+    version = Column(Integer, primary_key=True)
+    timestamp = Column(DateTime, server_default=func.now())
 
 
 class Annotation(Base):
+    """Annotated HTML of a text per stemmer, see populate.refresh_annotations()"""
+
     __tablename__ = "annotations"
 
     id = Column(Integer, primary_key=True)
@@ -68,5 +205,8 @@ class Annotation(Base):
 
     text_id = Column(Integer, nullable=False)
     stemmer = Column(String, nullable=False)
+    title = Column(String, comment="Annotated name of the text")
     html = Column(String, nullable=False)
     # text_id = relationship("Text", back_populates="appuser_rel")
+
+    __table_args__ = (Index("ix_annotations_stemmer_text_id", "stemmer", "text_id"),)
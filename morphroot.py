@@ -5,15 +5,11 @@ from settings import db_dir, CORPORA
 import os
 import csv
 
-from morphemes import Morphemes  # type: ignore
+from resources import morphemes
 
 morph_dir = f"{db_dir}/morphemes"
 morph_data = f"{morph_dir}/roots.csv"
 
-if not os.path.exists(morph_dir):
-    os.mkdir(morph_dir)
-m = Morphemes(morph_dir)
-
 roots: Dict[str, str] = {}
 
 
@@ -56,7 +52,7 @@ def get_root_morpheme(word: str) -> str:
     if not word.isalpha():
         roots[word] = word
         return word
-    tree = m.parse(word.lower()).get("tree")
+    tree = morphemes(morph_dir).parse(word.lower()).get("tree")
     if not tree:
         roots[word] = word
         return word
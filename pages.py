@@ -1,30 +1,32 @@
-from typing import Dict
+from typing import Dict, Iterator, Optional
 
 import os
 import csv
 from glob import glob
 
-import colorcet as cc  # type: ignore
 from urllib.parse import quote_plus
 
 from settings import VOCAB, CORPORA, CLEAN_THRESHOLD
 
 from corpora import corpora
-from stemmers import stemmers, stemmer_labels, default_stemmer
+from stemmers import stemmers, stemmer_labels, default_stemmer, stem_many
 from template import title_templ, span_templ, select_option_templ, table_templ
 from template import index_templ, corpus_templ, text_templ, list_templ, values_templ
 from template import value_link_templ, list_link_templ
 
-from util import fname2name, fname2path, path2corpus, path2name
-from datamodel import Annotator
+from util import fname2name, fname2path, path2corpus, path2name, clean_text
+from datamodel import Annotator, annotate
 from hyper import enrich_value
 
 # from create import tokenize_values, load_source, calc_occurences
 from persistence import tokenize_values, load_source, calc_occurences
 from persistence import corpora_stats, stemmers_values
+from persistence import corpus_annotations, text_annotation, token_offsets
 
 
 def values_css(stemmer: str, vocab: str) -> str:
+    import colorcet as cc  # type: ignore
+
     mapping: Dict[str, str] = {}
     with open(f"vocab/{stemmer}/{vocab}.csv") as f:
         for i, l in enumerate(csv.reader(f)):
@@ -73,7 +75,7 @@ def index_html() -> str:
 def page_corpus_html(
     corpus: str, stemmer: str, vocab: str, values_br: Dict[str, str] = {}
 ) -> str:
-    """generates a unified page for stories in a corpus
+    """generates a unified page for stories in a corpus, from the annotations stored per text
 
     Args:
         corpus (str): one of the corpora
@@ -83,24 +85,64 @@ def page_corpus_html(
     Returns:
         str: the annotated HTML page
     """
-    annotated = ""
-
-    fulltext = ""
-    for fname in sorted(glob(f"corpora.{CORPORA}/{corpus}/*.txt")):
-        with open(fname) as fin:
-            ftitle = fname2name(fname)
-            # parts = fname.split("_")[1:]
-            fid = "_".join(ftitle.split(" ")).lower()
-            # ftitle = " ".join(parts)
-            fulltext += (
-                "<br/>"
-                + title_templ.format(id=fid, level=2, content=ftitle)
-                + fin.read()
-                + "<br/>"
-            )
-    a = Annotator(stemmer, fulltext, values_br)
-    annotated = a.rich_text()
-    return corpus_templ.format(title=corpus, body=annotated)
+    return "".join(iter_corpus_html(corpus, stemmer, vocab, values_br))
+
+
+def iter_corpus_html(
+    corpus: str, stemmer: str, vocab: str, values_br: Dict[str, str] = {}
+) -> Iterator[str]:
+    """page_corpus_html() in parts, a text at a time, to be streamed"""
+    head, tail = corpus_templ.format(title=corpus, body="{body}").split("{body}")
+    yield head
+    for text_id, name, title, html, fulltext in corpus_annotations(stemmer, corpus):
+        fid = "_".join(name.split(" ")).lower()
+        # titles were annotated with the texts when the corpus was a single fulltext,
+        # they are stored with the annotations since
+        annotated_title = (
+            Annotator(stemmer, name, values_br).rich_line() if title is None else title
+        )
+        yield (
+            "<br/>"
+            + title_templ.format(id=fid, level=2, content=annotated_title)
+            + annotated_html(stemmer, text_id, html, fulltext, values_br)
+            + "<br/>"
+        )
+    yield tail
+
+
+def page_text_html(
+    corpus: str, stemmer: str, vocab: str, anchor: str, values_br: Dict[str, str] = {}
+) -> Optional[str]:
+    """The page of a single text of a corpus, None if there is no such text
+
+    Args:
+        anchor (str): the text within the corpus page, see util.fname2path()
+    """
+    found = text_annotation(stemmer, corpus, anchor)
+    if found is None:
+        return None
+    text_id, name, _, html, fulltext = found
+    return text_templ.format(
+        title=name, body=annotated_html(stemmer, text_id, html, fulltext, values_br)
+    )
+
+
+def annotated_html(
+    stemmer: str,
+    text_id: int,
+    html: Optional[str],
+    fulltext: Optional[str],
+    values_br: Dict[str, str],
+) -> str:
+    """The stored annotation of a text, see persistence.corpus_annotations().
+    Texts not annotated yet are annotated at the stored offsets of their words,
+    or tokenized when populated before the offsets were stored, see populate.py"""
+    if html is not None:
+        return html
+    hits = token_offsets(stemmer, text_id)
+    if hits is None:
+        return Annotator(stemmer, fulltext, values_br).rich_text()
+    return annotate(clean_text(fulltext), hits, values_br)
 
 
 def text_anchor_html(
@@ -175,7 +217,7 @@ def values_html(stemmer: str, vocab: str) -> str:
         for line in csv.reader(fin):
             if not line:
                 continue
-            stems = [stemmers[stemmer](v.strip(), None) for v in line]
+            stems = stem_many(stemmer, [v.strip() for v in line])
             links = {}
             # TODO: refactor: currently first handled separately in enrich_values, then merged and separated here
             first = None
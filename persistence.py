@@ -1,44 +1,96 @@
-from db import Session
+from typing import Callable, Iterator, Optional
+
+from db import session_scope
+from cache import bump_generation
+from settings import VOCAB
 import query
 
 from customtypes import ClassToTokenMap, TokenizedMap
 
 
+def refresh_vocab(vocab: str) -> None:
+    """Brings tokens and occurrences in line with an edited vocabulary, quickly enough
+    for a request: annotations and statistics are left to populate.py, see populate.refresh_values().
+    Only the configured vocabulary is stored, see populate.tokenize_values()"""
+    # populate.py imports the annotator, that reads the values through this module
+    from populate import refresh_values
+
+    if vocab == VOCAB:
+        with session_scope() as s:
+            refresh_values(s)
+    # the pages of any vocabulary show its file
+    bump_generation()
+
+
 def stemmers_values() -> dict[str, dict[str, int]]:
     """values x stemmers table"""
-    return query.get_stemmer2vocab(Session())
+    with session_scope() as s:
+        return query.stored_stemmer2vocab(s)
 
 
 def tokenize_values(stemmer: str = "dummy"):
-    return query.tokenize_values(Session(), stemmer)
+    with session_scope() as s:
+        return query.tokenize_values(s, stemmer)
+
+
+def corpus_annotations(stemmer: str, corpus: str):
+    with session_scope() as s:
+        yield from query.corpus_annotations(s, stemmer, corpus)
+
+
+def text_annotation(stemmer: str, corpus: str, anchor: str):
+    with session_scope() as s:
+        return query.text_annotation(s, stemmer, corpus, anchor)
+
+
+def token_offsets(stemmer: str, text_id: int):
+    with session_scope() as s:
+        return query.token_offsets(s, stemmer, text_id)
 
 
 def load_source(stemmer="dummy", corpora: list[str] = []):
-    return query.load_source(Session(), stemmer, corpora)
+    with session_scope() as s:
+        return query.load_source(s, stemmer, corpora)
+
+
+def iter_source(stemmer="dummy", corpora: list[str] = []):
+    with session_scope() as s:
+        yield from query.iter_source(s, stemmer, corpora)
+
+
+class SourceSentences:
+    """The tokenized sentences, streamed again from the database at each iteration,
+    as gensim models iterate the corpus once per epoch. See query.iter_source()"""
+
+    def __init__(
+        self,
+        stemmer: str = "dummy",
+        corpora: list[str] = [],
+        transform: Optional[Callable[[list[str]], list[str]]] = None,
+    ):
+        self.stemmer = stemmer
+        self.corpora = corpora
+        self.transform = transform
+
+    def __iter__(self) -> Iterator[list[str]]:
+        # closed by the iterating thread, gensim iterates in a thread of its own
+        with session_scope() as s:
+            for _, _, sentences in query.iter_source(s, self.stemmer, self.corpora):
+                for sentence in sentences:
+                    yield self.transform(sentence) if self.transform else sentence
 
 
 def calc_occurences(
     stemmer: str = "dummy", flat: bool = False, aggregated: bool = False
 ):
-    return query.calc_occurences(Session(), stemmer, flat, aggregated)
+    with session_scope() as s:
+        return query.calc_occurences(s, stemmer, flat, aggregated)
 
 
 def corpora_stats() -> dict[str, tuple[int, int, int, int]]:
-    """For each corpus returns: num. texts, num. words, num. sentences"""
-    s = Session()
-    stats = query.corpora_stats(s)
-    tkns = query.corpora_token_counts(s)
-    result: dict[str, tuple[int, int, int]] = {}
-    for c, texts in stats.items():
-        # print(texts)
-        result[c] = (texts[0], texts[1], texts[2], tkns[c])
-        #     len(texts),
-        #     sum(t[0] for t in texts.values()),
-        #     sum(t[1] for t in texts.values()),
-        #     tkns[c]
-        # )
-
-    return result
+    """For each corpus returns: num. texts, num. sentences, num. words, num. tokens"""
+    with session_scope() as s:
+        return query.stored_corpora_stats(s)
 
 
 if __name__ == "__main__":
@@ -4,11 +4,15 @@ To be executed standalone before using the application.
 
 Usage:
   populate.py -l
-  populate.py <stemmer>
+  populate.py [--bulk] [--incremental] [--workers=<n>] (--all | <stemmer>...)
 
 Options:
   -h --help             This information
   -l --list             List available stemmers
+  -a --all              Populate all the available stemmers in a single pass
+  -b --bulk             Write with pre-assigned ids through COPY/executemany instead of the ORM
+  -i --incremental      Only replace new or changed texts and delete removed ones
+  -w --workers=<n>      Processes reading, tokenizing and stemming the texts [default: 1]
   --version             Print version
 
 """
@@ -16,18 +20,32 @@ __version__ = "0.0.1"
 
 from docopt import docopt  # type: ignore
 
+from typing import Iterator
+
 import os
+import time
+import itertools
 from glob import glob
+from multiprocessing import Pool
 
-from db import Base, engine, Session
+from db import Session, session_scope
+from bulk import BulkLoader
+from cache import bump_generation
+from migrations import migrate, is_partitioned, partition_name, create_partition
 
-from customtypes import FulltextsMap, TokenizedMap
-from settings import VOCAB, CORPORA, LANG
-from stemmers import stemmers
+from customtypes import FulltextsMap, TokenizedMap, ParsedText
+from settings import VOCAB, CORPORA, LANG, STORAGE
+from stemmers import stemmers, stem_many
 from corpora import corpora as global_corpora
 
-from util import rmdirs, mkdirs, story_tokenize, fname2name
-from model import Token, Text, Annotation, Sentence, Word
+from sqlalchemy import insert, select, text  # type: ignore
+
+from util import rmdirs, mkdirs, story_spans, clean_text, fname2name, content_hash
+from model import Token, Text, Annotation, Sentence, Word, Stem, Form, Posting
+from query import refresh_occurrences, link_lexicon, refresh_stats
+from query import token_offsets_many, Offsets
+from query import tokenize_values as stored_values
+from datamodel import Annotator, annotate
 
 from flatvalues import flatten
 
@@ -39,7 +57,6 @@ def drop_tokenized_values(s: Session, stemmer: str) -> None:
 
 
 def tokenize_values(s: Session, stemmer: str, vocab: str = "") -> None:
-    token_func = stemmers[stemmer]
     if not vocab:
         vocab = VOCAB
     if vocab.endswith(".flat") and not os.path.exists(f"vocab/{vocab}.csv"):
@@ -52,7 +69,7 @@ def tokenize_values(s: Session, stemmer: str, vocab: str = "") -> None:
                 continue
             token_class = l.split(",")[0]
             fitems = [x.strip().lower() for x in l.split(",") if x.strip()]
-            stemmed_fitems = [token_func(x, None) for x in fitems]
+            stemmed_fitems = stem_many(stemmer, fitems)
             s.add_all(
                 [
                     Token(token=token, stemmer=stemmer, token_class=token_class)
@@ -67,117 +84,451 @@ def tokenize_values(s: Session, stemmer: str, vocab: str = "") -> None:
         fout.writelines(outlines)
 
 
-def drop_source(s: Session, stemmer: str):
-    texts = s.query(Text).join(Sentence, Sentence.text_id == Text.id).join(Word, Word.sentence_id == Sentence.id).where(Word.stemmer == stemmer).all()
-    for t in texts:
-        s.delete(t)
-    sents = s.query(Sentence).join(Word, Word.sentence_id == Sentence.id).where(Word.stemmer == stemmer).all()
-    for sent in sents:
-        s.delete(sent)
-    s.query(Word).where(Word.stemmer == stemmer).delete()
+def refresh_values(s: Session) -> list[str]:
+    """Reloads the values for every stored stemmer, e.g. after the vocabulary has been edited.
+    For the stemmers whose tokens changed, recounts the occurrences and drops the annotations,
+    that pages annotate on the fly until the next populate.py --incremental stores them again
+    along with the statistics.
+
+    Returns:
+        list[str]: the stemmers whose tokens changed
+    """
+    changed = []
+    for stemmer in stored_stemmers(s):
+        tokens = stored_tokens(s, stemmer)
+        drop_tokenized_values(s, stemmer)
+        tokenize_values(s, stemmer)
+        if stored_tokens(s, stemmer) != tokens:
+            changed.append(stemmer)
+    link_lexicon(s)
+    for stemmer in changed:
+        refresh_occurrences(s, stemmer)
+        s.query(Annotation).where(Annotation.stemmer == stemmer).delete(
+            synchronize_session=False
+        )
+    return changed
+
+
+TEXTS_PER_BATCH = 64
+"""Texts annotated at a time by refresh_annotations()"""
+
+AnnotateJob = tuple[str, dict[str, str], list[tuple[int, str, str, Offsets]]]
+"""stemmer, values and (text id, name, fulltext, offsets) of a batch of texts"""
+
+
+def annotate_batch(job: AnnotateJob) -> list[tuple[int, str, str]]:
+    """The annotated title and HTML of a batch of texts, touches no database like parse_job().
+    Titles, and texts stored before the offsets of their words, are tokenized"""
+    stemmer, values_br, texts = job
+    return [
+        (
+            text_id,
+            Annotator(stemmer, name, values_br).rich_line(),
+            (
+                Annotator(stemmer, fulltext, values_br).rich_text()
+                if offsets is None
+                else annotate(clean_text(fulltext), offsets, values_br)
+            ),
+        )
+        for text_id, name, fulltext, offsets in texts
+    ]
+
+
+def refresh_annotations(
+    s: Session, stemmer: str, only_missing: bool = False, workers: int = 1
+) -> int:
+    """Stores the annotated HTML of every text, or only of the texts not annotated yet,
+    that pages.page_corpus_html() assembles. Texts are streamed in batches of
+    TEXTS_PER_BATCH with their offsets, and annotated in a process pool with more workers.
+
+    Returns:
+        int: the number of texts annotated
+    """
+    texts = s.query(Text.id, Text.name, Text.fulltext).order_by(Text.id)
+    if only_missing:
+        annotated = select(Annotation.text_id).where(Annotation.stemmer == stemmer)
+        texts = texts.where(Text.id.not_in(annotated))
+    else:
+        s.query(Annotation).where(Annotation.stemmer == stemmer).delete(
+            synchronize_session=False
+        )
+    _, values_br = stored_values(s, stemmer)
+
+    def jobs() -> Iterator[AnnotateJob]:
+        rows = iter(texts.yield_per(TEXTS_PER_BATCH))
+        while batch := list(itertools.islice(rows, TEXTS_PER_BATCH)):
+            hits = token_offsets_many(s, stemmer, [text_id for text_id, *_ in batch])
+            yield stemmer, values_br, [
+                (text_id, name, fulltext, hits[text_id])
+                for text_id, name, fulltext in batch
+            ]
+
+    def store(annotated: list[tuple[int, str, str]]) -> int:
+        s.execute(
+            insert(Annotation),
+            [
+                {"text_id": text_id, "stemmer": stemmer, "title": title, "html": html}
+                for text_id, title, html in annotated
+            ],
+        )
+        return len(annotated)
+
+    count = 0
+    if workers <= 1:
+        for annotated in map(annotate_batch, jobs()):
+            count += store(annotated)
+    else:
+        with Pool(workers) as pool:
+            # the batches are read here, as the pool would read them in a thread
+            pending = jobs()
+            while batches := list(itertools.islice(pending, workers)):
+                for annotated in pool.imap(annotate_batch, batches):
+                    count += store(annotated)
     s.commit()
+    return count
 
 
-def load_source(
-    s: Session, corpus: str, fname: str, stemmer="dummy", corpora: list[str] = []
-):
-    """loads the sources from the specified directory structure
+def stored_tokens(s: Session, stemmer: str) -> set[tuple[str, str]]:
+    """The (token, value) of a stemmer, to tell whether the vocabulary changed"""
+    return set(s.query(Token.token, Token.token_class).where(Token.stemmer == stemmer))
 
-    Args:
-        token_func (_type_): the used stemmer as a function. Defaults to None leads to use of dummy stemmer.
-        corpora (List[str]): a list of subdirectories. Corresponds to corpora.corpora.
-        Defaults to empty list, which leads to reading all subdirectories of corpora/
+
+def drop_source(s: Session) -> float:
+    """Drops texts, sentences and words, shared by all stemmers, and their annotations.
+    Set-based, so nothing is loaded: TRUNCATE on PostgreSQL, DELETE elsewhere.
 
     Returns:
-        Tuple[Dict[str, Dict[str, str]], Dict[str, Dict[str, List[List[str]]]]]: returns two dictionaries:
-            corpora->text_name->fulltext and corpora->text_name->list of tokenized sentences
+        float: the seconds it took
     """
-    with open(fname) as f:
-        # print("=============== " + fname)
-        textname = fname.split("/")[-1].split(".")[-2]
-        assert textname, f"Seems not to contain file name: {fname}"
-        content = "".join(f.readlines())
-        txt = Text(
-            fname=textname,
-            name=fname2name(textname),
-            corpus=corpus,
-            fulltext=content,
+    started = time.perf_counter()
+    tables = [t.__table__ for t in (Text, Sentence, Word, Posting, Annotation)]
+    if s.get_bind().dialect.name == "postgresql":
+        names = ", ".join(t.name for t in tables)
+        s.execute(text(f"TRUNCATE {names} RESTART IDENTITY"))
+    else:
+        for t in tables:
+            s.execute(t.delete())
+    s.commit()
+    return time.perf_counter() - started
+
+
+def drop_stems(s: Session, stemmer: str) -> None:
+    """Drops the tokens of a stemmer, a partition drop where partitioned"""
+    if is_partitioned(s):
+        s.execute(
+            text(f"DROP TABLE IF EXISTS {partition_name(Stem.__tablename__, stemmer)}")
         )
-        s.add(txt)
-        s.flush()
-        # print(content)
-        tokenized = story_tokenize(content)
-        # print(tokenized)
-        for i, sentence in enumerate(tokenized):
-            s_text = " ".join(sentence)
-            sent = Sentence(order=i, text_id=txt.id, sentence=s_text)
-            s.add(sent)
-            s.flush()
-            s.add_all(
-                [
-                    Word(
-                        word=word,
-                        order=j,
-                        sentence_id=sent.id,
-                        stemmer=stemmer,
-                        token=stemmers[stemmer](word, None),
-                    )
-                    for j, word in enumerate(sentence)
-                ]
-            )
+    else:
+        s.query(Stem).where(Stem.stemmer == stemmer).delete()
     s.commit()
 
 
-if __name__ == "__main__":
-    args = docopt(__doc__, version=__version__)
+def stored_stemmers(s: Session) -> list[str]:
+    return [stemmer for stemmer, in s.query(Stem.stemmer).distinct()]
 
-    # print(args)
 
-    if "--list" in args and args["--list"]:
-        print(f"Available stemmers for '{LANG}':")
-        print("\n".join(stemmers))
-        exit(0)
+def fname2textname(fname: str) -> str:
+    textname = fname.split("/")[-1].split(".")[-2]
+    assert textname, f"Seems not to contain file name: {fname}"
+    return textname
+
+
+def read_source(fname: str) -> str:
+    with open(fname) as f:
+        return "".join(f.readlines())
+
 
-    stem = args["<stemmer>"]
+def parse_source(corpus: str, fname: str, stemmers: list[str]) -> ParsedText:
+    """Reads and tokenizes a text file once, and stems its words with every given stemmer.
+    Touches no database, so that it can run in a worker process.
 
-    Base.metadata.create_all(engine)
-    s = Session()
+    Args:
+        corpus (str): the corpus the file belongs to. Corresponds to corpora.corpora.
+        fname (str): path to the text file
+        stemmers (list[str]): stemmer names as in stemmers.py
+
+    Returns:
+        ParsedText: the text with its sentences as lists of words, and the word->token maps
+    """
+    textname = fname2textname(fname)
+    content = read_source(fname)
+    # tokenized as annotated, so that the offsets of the words apply to the annotation
+    cleaned = clean_text(content)
+    spans = story_spans(cleaned)
+    offsets = [words for *_, words in spans]
+    tokenized = [[cleaned[start:end] for start, end in words] for words in offsets]
+    words = list(dict.fromkeys(itertools.chain(*tokenized)))
+    return ParsedText(
+        corpus=corpus,
+        fname=textname,
+        name=fname2name(textname),
+        fulltext=content,
+        content_hash=content_hash(content),
+        sentences=tokenized,
+        spans=[(start, end) for start, end, _ in spans],
+        offsets=offsets,
+        stems={stem: dict(zip(words, stem_many(stem, words))) for stem in stemmers},
+    )
+
+
+def parse_job(job: tuple[str, str, list[str]]) -> ParsedText:
+    """parse_source() over a single argument, as Pool.imap() expects"""
+    return parse_source(*job)
+
+
+def drop_texts(s: Session, text_ids: list[int]) -> None:
+    """Deletes the texts together with their sentences, words and annotations"""
+    if not text_ids:
+        return
+    sentences = select(Sentence.id).where(Sentence.text_id.in_(text_ids))
+    s.query(Word).where(Word.sentence_id.in_(sentences)).delete(
+        synchronize_session=False
+    )
+    s.query(Posting).where(Posting.sentence_id.in_(sentences)).delete(
+        synchronize_session=False
+    )
+    s.query(Sentence).where(Sentence.text_id.in_(text_ids)).delete(
+        synchronize_session=False
+    )
+    s.query(Annotation).where(Annotation.text_id.in_(text_ids)).delete(
+        synchronize_session=False
+    )
+    s.query(Text).where(Text.id.in_(text_ids)).delete(synchronize_session=False)
+    s.commit()
 
-    rmdirs()
-    mkdirs()
 
-    drop_tokenized_values(s, stem)
-    drop_source(s, stem)
+def stale_sources(
+    s: Session, sources: list[tuple[str, str]]
+) -> tuple[list[tuple[str, str]], list[int]]:
+    """Compares the texts on disk with the stored ones by their content hash
 
-    print(f">>> TOKENIZE VALUES with {stem}")
-    tokenize_values(s, stem)
+    Returns:
+        tuple[list[tuple[str, str]], list[int]]: the sources that are new or changed,
+            and the ids of the stored texts that are changed or no longer on disk
+    """
+    stored = {
+        (corpus, fname): (text_id, digest)
+        for corpus, fname, text_id, digest in s.query(
+            Text.corpus, Text.fname, Text.id, Text.content_hash
+        )
+    }
+    todo = []
+    for corpus, fname in sources:
+        key = (corpus, fname2textname(fname))
+        text_id, digest = stored.pop(key, (None, None))
+        if digest != content_hash(read_source(fname)):
+            todo += [(corpus, fname)]
+            if text_id is not None:
+                stored[key] = (text_id, digest)
+    return todo, [text_id for text_id, _ in stored.values()]
+
+
+def known_stems(s: Session, stemmers: list[str]) -> dict[str, set[str]]:
+    """The words that already have a token, per stemmer"""
+    known: dict[str, set[str]] = {stem: set() for stem in stemmers}
+    for stem, word in s.query(Stem.stemmer, Stem.word).where(
+        Stem.stemmer.in_(stemmers)
+    ):
+        known[stem].add(word)
+    return known
+
+
+def new_stems(known: dict[str, set[str]], parsed: ParsedText) -> list[dict]:
+    """The stems of the parsed text that are not stored yet. Updates known."""
+    rows = []
+    for stem, tokens in parsed.stems.items():
+        for word, token in tokens.items():
+            if word not in known[stem]:
+                known[stem].add(word)
+                rows += [{"stemmer": stem, "word": word, "token": token}]
+    return rows
+
+
+def complete_stems(s: Session, stemmer: str) -> int:
+    """Adds the tokens of the stored words that the stemmer has not seen,
+    e.g. texts skipped by an incremental run, or a stemmer added later.
 
-    for corpus in global_corpora:
-        for fname in glob(f"./corpora.{CORPORA}/{corpus}/*.txt"):
-	    print(f">>> TOKENIZE {fname} with {stem}")
-            load_source(s, corpus, fname, stem)
+    Returns:
+        int: the number of stems added
+    """
+    stemmed = select(Stem.word).where(Stem.stemmer == stemmer)
+    # forms cover both storages, see link_lexicon()
+    words = [word for word, in s.query(Form.word).where(Form.word.not_in(stemmed))]
+    s.add_all(
+        [
+            Stem(stemmer=stemmer, word=word, token=token)
+            for word, token in zip(words, stem_many(stemmer, words))
+        ]
+    )
+    s.commit()
+    return len(words)
 
-    # for stem in stemmers:
-    #     print(stem)
-    #     # print("=============== TOKENIZE VALUES")
-    #     tokenize_values(s, stem)
 
-    #     for corpus in global_corpora:
-    #         for fname in glob(f"./corpora.{CORPORA}/{corpus}/*.txt"):
-    #             load_source(s, corpus, fname, stem)
+def load_source(s: Session, parsed: ParsedText, stems: list[dict]) -> int:
+    """Inserts a parsed text and the new stems through the ORM
 
-    #     # corpus = "1_full"
-    #     # for fname in glob(f"./corpora.{CORPORA}/{corpus}/*.txt"):
-    #     #     load_source(s, corpus, fname, stem)
+    Returns:
+        int: the number of words inserted
+    """
+    count = 0
+    txt = Text(
+        fname=parsed.fname,
+        name=parsed.name,
+        corpus=parsed.corpus,
+        fulltext=parsed.fulltext,
+        content_hash=parsed.content_hash,
+    )
+    s.add(txt)
+    s.flush()
+    for i, (sentence, (start, end), offsets) in enumerate(
+        zip(parsed.sentences, parsed.spans, parsed.offsets)
+    ):
+        s_text = " ".join(sentence)
+        sent = Sentence(
+            order=i, text_id=txt.id, sentence=s_text, char_start=start, char_end=end
+        )
+        s.add(sent)
+        s.flush()
+        s.add_all(
+            [
+                Word(
+                    word=word,
+                    order=j,
+                    sentence_id=sent.id,
+                    char_start=word_start,
+                    char_end=word_end,
+                )
+                for j, (word, (word_start, word_end)) in enumerate(
+                    zip(sentence, offsets)
+                )
+            ]
+        )
+        count += len(sentence)
+    s.add_all([Stem(**row) for row in stems])
+    s.commit()
+    return count
 
-    #     # corpus = "2_consolidated"
-    #     # for fname in glob(f"./corpora.{CORPORA}/{corpus}/*.txt"):
-    #     #     load_source(s, corpus, fname, stem)
 
-    #     # corpus = "3_majority"
-    #     # for fname in glob(f"./corpora.{CORPORA}/{corpus}/*.txt"):
-    #     #     load_source(s, corpus, fname, stem)
+def bulk_load_source(loader: BulkLoader, parsed: ParsedText, stems: list[dict]) -> int:
+    """Same as load_source(), but buffers the rows in a BulkLoader.
 
-    #     # corpus = "4_split"
-    #     # for fname in glob(f"./corpora.{CORPORA}/{corpus}/*.txt"):
-    #     #     load_source(s, corpus, fname, stem)
+    Returns:
+        int: the number of words buffered
+    """
+    loader.add_text(parsed)
+    loader.add_stems(stems)
+    return sum(len(sentence) for sentence in parsed.sentences)
+
+
+def list_sources() -> list[tuple[str, str]]:
+    """All (corpus, path) of the texts on disk, in a stable order"""
+    return [
+        (corpus, fname)
+        for corpus in global_corpora
+        for fname in sorted(glob(f"./corpora.{CORPORA}/{corpus}/*.txt"))
+    ]
+
+
+def parse_sources(
+    sources: list[tuple[str, str]], stemmers: list[str], workers: int = 1
+) -> Iterator[ParsedText]:
+    """Parses the texts in the given order.
+    With more than one worker the parsing runs in a process pool,
+    while the results are still yielded in order to the single caller that writes them.
+    """
+    jobs = [(corpus, fname, stemmers) for corpus, fname in sources]
+    if workers <= 1:
+        yield from map(parse_job, jobs)
+        return
+    with Pool(workers) as pool:
+        yield from pool.imap(parse_job, jobs)
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__, version=__version__)
+
+    # print(args)
+
+    if "--list" in args and args["--list"]:
+        print(f"Available stemmers for '{LANG}':")
+        print("\n".join(stemmers))
+        exit(0)
+
+    requested = list(stemmers) if args["--all"] else args["<stemmer>"]
+    for stem in requested:
+        assert stem in stemmers, f"Unknown stemmer '{stem}', see --list"
+
+    migrate()
+    with session_scope() as s:
+        # stemmers populated earlier are kept in line with the texts
+        stems = list(dict.fromkeys(requested + stored_stemmers(s)))
+
+        sources = list_sources()
+        if args["--incremental"]:
+            mkdirs()
+            total = len(sources)
+            sources, stale = stale_sources(s, sources)
+            print(
+                f">>> {total - len(sources)} unchanged texts, {len(sources)} to load,"
+                f" {len(stale)} to delete"
+            )
+            drop_texts(s, stale)
+        else:
+            rmdirs()
+            mkdirs()
+            print(f">>> DROPPED SOURCE in {drop_source(s):.2f}s")
+            for stem in requested:
+                drop_stems(s, stem)
+
+        changed = set()
+        for stem in stems:
+            create_partition(s, stem)
+            s.commit()
+            tokens = stored_tokens(s, stem)
+            drop_tokenized_values(s, stem)
+            print(f">>> TOKENIZE VALUES with {stem}")
+            tokenize_values(s, stem)
+            if stored_tokens(s, stem) != tokens:
+                changed.add(stem)
+
+        known = known_stems(s, stems)
+        # arrays are only written in bulk
+        loader = BulkLoader(s) if args["--bulk"] or STORAGE == "arrays" else None
+        words = 0
+        started = time.perf_counter()
+        for parsed in parse_sources(sources, stems, int(args["--workers"])):
+            print(
+                f">>> TOKENIZED {parsed.corpus}/{parsed.fname} with {', '.join(stems)}"
+            )
+            if loader:
+                words += bulk_load_source(loader, parsed, new_stems(known, parsed))
+            else:
+                words += load_source(s, parsed, new_stems(known, parsed))
+        if loader:
+            loader.commit()
+        elapsed = time.perf_counter() - started
+        print(
+            f">>> {words} words in {elapsed:.1f}s ({words / max(elapsed, 1e-9):.0f} words/sec)"
+        )
+
+        link_lexicon(s)
+        for stem in stems:
+            added = complete_stems(s, stem)
+            if added:
+                print(f">>> {added} more words stemmed with {stem}")
+        link_lexicon(s)
+        s.commit()
+
+        for stem in stems:
+            print(f">>> {refresh_occurrences(s, stem)} OCCURRENCES with {stem}")
+            s.commit()
+        refresh_stats(s)
+        s.commit()
+
+        # texts already annotated stay as they are, unless the values changed
+        for stem in stems:
+            annotated = refresh_annotations(
+                s, stem, stem not in changed, int(args["--workers"])
+            )
+            print(f">>> {annotated} TEXTS ANNOTATED with {stem}")
+    print(f">>> DATA GENERATION {bump_generation()}")
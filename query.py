@@ -1,14 +1,24 @@
+from typing import Iterator, Optional
+
+import itertools
+
 from customtypes import TokenToClassMap, ClassToTokenMap
 
-from sqlalchemy import func, distinct, and_, text
+from sqlalchemy import func, distinct, and_, text, select, insert, delete
+from sqlalchemy import literal_column, case
 from sqlalchemy.sql import expression, functions
 
-from db import Session
+from db import Session, session_scope
+from settings import STORAGE
+from util import unpack_ids
 
 from corpora import corpora as global_corpora
-from stemmers import stemmers
 
-from model import Token, Text, Sentence, Word
+from model import Token, Text, Sentence, Word, Stem, Occurrence, Posting
+from model import CorpusStats, StemmerStats, Annotation
+
+YIELD_PER = 10_000
+"""Rows fetched at a time by the server-side cursor of iter_source()"""
 
 
 def tokenize_values(
@@ -28,6 +38,7 @@ def tokenize_values(
     data = (
         s.query(Token.token, func.lower(Token.token_class))
         .filter(Token.stemmer == stemmer)
+        .order_by(Token.id)
         .all()
     )
     values: ClassToTokenMap = {}
@@ -52,7 +63,10 @@ def flat_tokenize_values(
             value->list_labels and label->value
     """
     data = (
-        s.query(Token.token, Token.token_class).filter(Token.stemmer == stemmer).all()
+        s.query(Token.token, Token.token_class)
+        .filter(Token.stemmer == stemmer)
+        .order_by(Token.id)
+        .all()
     )
     values: ClassToTokenMap = {}
     valuesbackref = dict(data)
@@ -81,39 +95,89 @@ def load_source(
     fulltexts: dict[str, dict[str, str]] = {}
     tokenized: dict[str, dict[str, list[list[str]]]] = {}
     for corpus in corpora:
-        # print(corpus)
-        data = s.query(Text.name, Text.fulltext).filter(Text.corpus == corpus).all()
+        data = (
+            s.query(Text.name, Text.fulltext)
+            .filter(Text.corpus == corpus)
+            .order_by(Text.id)
+            .all()
+        )
         fulltexts[corpus] = dict(data)
-        tokenized[corpus] = {}
-        for textname in fulltexts[corpus].keys():
-            # print(textname)
-            tokenized[corpus][textname] = []
-            data = (
-                s.query(Word, Sentence, Text)
-                .filter(
-                    Word.sentence_id == Sentence.id,
-                    Sentence.text_id == Text.id,
-                    Text.name == textname,
-                    Word.stemmer == stemmer,
-                )
-                .order_by(Sentence.order, Word.order)
-                .all()
-            )
-            sent_id = None
-            sent: list[str] = []
-            for w, sentence, t in data:
-                if sentence.id != sent_id:
-                    sent_id = sentence.id
-                    if sent:
-                        tokenized[corpus][textname] += [sent]
-                    sent = [w.token]
-                else:
-                    sent += [w.token]
-            tokenized[corpus][textname] += [sent]
+        # texts without stemmed words are not streamed
+        tokenized[corpus] = {textname: [[]] for textname in fulltexts[corpus]}
+        for _, textname, sentences in iter_source(s, stemmer, [corpus]):
+            tokenized[corpus][textname] = sentences
 
     return fulltexts, tokenized
 
 
+def iter_source(
+    s: Session, stemmer="dummy", corpora: list[str] = []
+) -> Iterator[tuple[str, str, list[list[str]]]]:
+    """Streams the tokenized texts, with a single ordered query per corpus
+    read through a server-side cursor, so only one text at a time is held in memory.
+
+    Args:
+        stemmer (str): stemmer name as in stemmers.py
+        corpora (List[str]): a list of subdirectories. Corresponds to corpora.corpora.
+        Defaults to empty list, which leads to reading all corpora
+
+    Yields:
+        Tuple[str, str, List[List[str]]]: corpus, text name and list of tokenized sentences
+    """
+    if not corpora:
+        corpora = global_corpora
+
+    for corpus in corpora:
+        if STORAGE == "arrays":
+            yield from iter_sentence_arrays(s, stemmer, corpus)
+        else:
+            yield from iter_word_rows(s, stemmer, corpus)
+
+
+def iter_word_rows(
+    s: Session, stemmer: str, corpus: str
+) -> Iterator[tuple[str, str, list[list[str]]]]:
+    """A row per word, grouped back into sentences"""
+    rows = (
+        s.query(Text.id, Text.name, Sentence.id, Stem.token)
+        .join(Sentence, Sentence.text_id == Text.id)
+        .join(Word, Word.sentence_id == Sentence.id)
+        .join(Stem, and_(Stem.form_id == Word.form_id, Stem.stemmer == stemmer))
+        .filter(Text.corpus == corpus)
+        .order_by(Text.id, Sentence.order, Word.order)
+        .yield_per(YIELD_PER)
+    )
+    for (_, textname), text_rows in itertools.groupby(rows, lambda r: r[:2]):
+        sentences = [
+            [token for *_, token in sentence]
+            for _, sentence in itertools.groupby(text_rows, lambda r: r[2])
+        ]
+        yield corpus, textname, sentences
+
+
+def iter_sentence_arrays(
+    s: Session, stemmer: str, corpus: str
+) -> Iterator[tuple[str, str, list[list[str]]]]:
+    """A single sequential read of the sentences, mapped to tokens on the client"""
+    tokens = dict(s.query(Stem.form_id, Stem.token).where(Stem.stemmer == stemmer))
+    rows = (
+        s.query(Text.id, Text.name, Sentence.forms)
+        .join(Sentence, Sentence.text_id == Text.id)
+        .filter(Text.corpus == corpus)
+        .order_by(Text.id, Sentence.order)
+        .yield_per(YIELD_PER)
+    )
+    for (_, textname), text_rows in itertools.groupby(rows, lambda r: r[:2]):
+        # words without a token are skipped, as the join of iter_word_rows() does
+        sentences = [
+            [tokens[form] for form in unpack_ids(forms) if form in tokens]
+            for *_, forms in text_rows
+        ]
+        sentences = [sentence for sentence in sentences if sentence]
+        if sentences:
+            yield corpus, textname, sentences
+
+
 def calc_occurences(
     s: Session, stemmer: str = "dummy", flat: bool = False, aggregated: bool = False
 ) -> tuple[
@@ -133,41 +197,42 @@ def calc_occurences(
             where text_name is in the format <corpus>/<chapter>_<text> (no extension)
     """
     # print(tokenized)
-    token_func = stemmers[stemmer]
     occurences: dict[tuple[str, str], int] = {}  # (text_name, value): count)
     occurences_tv: dict[str, dict[str, int]] = {}  # text_name: (value: count)
     occurences_backref: dict[str, dict[str, int]] = {}  # value: (text_name:count)
 
-    token_col = Token.token if flat else Token.token_class
-    # group_col = Text.corpus if aggregated else Text.name
+    # distinct tokens never share words, a word counted for the same
+    # lowercase value through several classes is counted once
+    hits = (
+        select(
+            Occurrence.corpus,
+            Occurrence.name,
+            Occurrence.text_id,
+            Occurrence.token,
+            func.lower(Occurrence.token if flat else Occurrence.token_class).label(
+                "value"
+            ),
+            Occurrence.count,
+        )
+        .distinct()
+        .where(Occurrence.stemmer == stemmer)
+        .subquery()
+    )
     group_cols = (
-        (Text.corpus, token_col) if aggregated else (Text.corpus, Text.name, token_col)
+        (hits.c.corpus, hits.c.value)
+        if aggregated
+        else (hits.c.corpus, hits.c.name, hits.c.value)
     )
     text_col = (
-        # sqlite version
-        Text.corpus
+        hits.c.corpus
         if aggregated
-        else Text.corpus + expression.literal("/") + Text.name
-        # postgres version
-        # Text.corpus if aggregated else functions.concat(Text.corpus, expression.literal("/"), Text.name)
+        else hits.c.corpus + expression.literal("/") + hits.c.name
     )
-    data = (
-        s.query(
-            text_col,
-            func.lower(token_col),
-            func.count(distinct(Word.id)).label("cnt"),
-        )
-        # s.query(func.concat(Text.corpus, expression.literal("/"), Text.name), func.lower(Token.token_class), func.count(distinct(Word.id)).label('cnt'))
-        .join(Sentence, Sentence.text_id == Text.id)
-        .join(Word, Word.sentence_id == Sentence.id)
-        .filter(
-            Word.token == Token.token,
-            Word.stemmer == Token.stemmer,
-            Word.stemmer == stemmer,
-        )
+    data = s.execute(
+        select(text_col, hits.c.value, func.sum(hits.c.count))
         .group_by(*group_cols)
-        .all()
-    )
+        .order_by(*group_cols)
+    ).all()
 
     occurences = dict(((text, value), count) for text, value, count in data)
 
@@ -187,13 +252,97 @@ def calc_occurences(
     return occurences, occurences_tv, occurences_backref
 
 
-def get_stemmer2vocab(s: Session) -> dict[str, dict[str, int]]:
-    q = """SELECT count(words.id), words.stemmer, token_class
-    FROM words, tokens
-    WHERE words.token = tokens.token AND words.stemmer = tokens.stemmer
-    GROUP BY words.stemmer, token_class;"""
-    # data = s.execute(q)
-    data = s.execute(text(q))
+def link_lexicon(s: Session) -> None:
+    """Assigns the integer ids that words, stems and tokens are joined on,
+    to the rows that have none yet, see model.Form and model.Lexicon.
+    Set-based, to be run whenever words, stems or tokens are added."""
+    s.execute(text("""INSERT INTO forms (word)
+            SELECT DISTINCT word FROM (
+                SELECT word FROM words WHERE form_id IS NULL
+                UNION SELECT word FROM stems WHERE form_id IS NULL
+            ) AS new
+            WHERE NOT EXISTS (SELECT 1 FROM forms WHERE forms.word = new.word)"""))
+    for table in ("words", "stems"):
+        s.execute(text(f"""UPDATE {table} SET form_id =
+                (SELECT id FROM forms WHERE forms.word = {table}.word)
+                WHERE form_id IS NULL"""))
+    s.execute(text("""INSERT INTO lexicon (stemmer, token)
+            SELECT DISTINCT stemmer, token FROM (
+                SELECT stemmer, token FROM stems WHERE token_id IS NULL
+                UNION SELECT stemmer, token FROM tokens WHERE token_id IS NULL
+            ) AS new
+            WHERE NOT EXISTS (
+                SELECT 1 FROM lexicon
+                WHERE lexicon.stemmer = new.stemmer AND lexicon.token = new.token
+            )"""))
+    for table in ("stems", "tokens"):
+        s.execute(text(f"""UPDATE {table} SET token_id =
+                (SELECT id FROM lexicon
+                WHERE lexicon.stemmer = {table}.stemmer AND lexicon.token = {table}.token)
+                WHERE token_id IS NULL"""))
+
+
+def refresh_occurrences(s: Session, stemmer: str) -> int:
+    """Recomputes the occurrences of the vocabulary tokens in each text, see model.Occurrence.
+    Set-based, to be run whenever texts or tokens of the stemmer change.
+
+    Returns:
+        int: the number of (text, token) pairs found
+    """
+    s.execute(delete(Occurrence).where(Occurrence.stemmer == stemmer))
+    hits = word_hits()
+    tokens = (
+        select(Token.token_id, Token.token, Token.token_class)
+        .distinct()
+        .where(Token.stemmer == stemmer)
+        .subquery()
+    )
+    counts = (
+        select(
+            Stem.stemmer,
+            Text.corpus,
+            Text.id,
+            Text.name,
+            tokens.c.token,
+            tokens.c.token_class,
+            func.sum(hits.c.freq),
+        )
+        .join_from(Text, Sentence, Sentence.text_id == Text.id)
+        .join(hits, hits.c.sentence_id == Sentence.id)
+        .join(Stem, and_(Stem.form_id == hits.c.form_id, Stem.stemmer == stemmer))
+        .join(tokens, tokens.c.token_id == Stem.token_id)
+        .group_by(
+            Stem.stemmer,
+            Text.corpus,
+            Text.id,
+            Text.name,
+            tokens.c.token,
+            tokens.c.token_class,
+        )
+    )
+    cols = ["stemmer", "corpus", "text_id", "name", "token", "token_class", "count"]
+    return s.execute(insert(Occurrence).from_select(cols, counts)).rowcount
+
+
+def word_hits(storage: str = STORAGE):
+    """The words of the texts as (sentence_id, form_id, freq), whatever the storage"""
+    if storage == "arrays":
+        hits = select(Posting.sentence_id, Posting.form_id, Posting.freq)
+    else:
+        hits = select(Word.sentence_id, Word.form_id, literal_column("1").label("freq"))
+    return hits.subquery("hits")
+
+
+def get_stemmer2vocab(s: Session, storage: str = STORAGE) -> dict[str, dict[str, int]]:
+    hits = word_hits(storage)
+    data = (
+        s.query(func.sum(hits.c.freq), Stem.stemmer, Token.token_class)
+        .select_from(hits)
+        .join(Stem, Stem.form_id == hits.c.form_id)
+        .join(Token, Token.token_id == Stem.token_id)
+        .group_by(Stem.stemmer, Token.token_class)
+        .all()
+    )
     result: dict[str, dict[str, int]] = {}
     for cnt, stem, value in data:
         if value not in result:
@@ -204,18 +353,20 @@ def get_stemmer2vocab(s: Session) -> dict[str, dict[str, int]]:
     return result
 
 
-def corpora_stats(s: Session) -> dict[str, tuple[int, int, int]]:
+def corpora_stats(
+    s: Session, storage: str = STORAGE
+) -> dict[str, tuple[int, int, int]]:
+    hits = word_hits(storage)
     data = (
         s.query(
             Text.corpus,
             func.count(distinct(Text.name)).label("text_cnt"),
             func.count(distinct(Sentence.id)).label("sent_count"),
-            func.count(distinct(Word.id)).label("word_cnt"),
+            func.sum(hits.c.freq).label("word_cnt"),
         )
         .where(
             Sentence.text_id == Text.id,
-            Word.sentence_id == Sentence.id,
-            "dummy" == Word.stemmer,
+            hits.c.sentence_id == Sentence.id,
         )
         .group_by(Text.corpus)
         .all()
@@ -235,20 +386,22 @@ def corpora_stats(s: Session) -> dict[str, tuple[int, int, int]]:
     return tokens
 
 
-def corpora_token_counts(s: Session) -> dict[str, int]:
+def corpora_token_counts(s: Session, storage: str = STORAGE) -> dict[str, int]:
+    hits = word_hits(storage)
     data = (
         s.query(
             Text.corpus,
             func.count(distinct(Text.name)).label("text_cnt"),
             func.count(distinct(Sentence.id)).label("sent_count"),
-            func.count(distinct(Word.id)).label("word_cnt"),
+            func.sum(hits.c.freq).label("word_cnt"),
             func.count(distinct(Token.id)).label("token_cnt"),
         )
         .where(
             Sentence.text_id == Text.id,
-            Word.sentence_id == Sentence.id,
-            "dummy" == Word.stemmer,
-            Word.token == Token.token,
+            hits.c.sentence_id == Sentence.id,
+            Stem.form_id == hits.c.form_id,
+            "dummy" == Stem.stemmer,
+            Stem.token == Token.token,
         )
         .group_by(Text.corpus)
         .all()
@@ -257,11 +410,185 @@ def corpora_token_counts(s: Session) -> dict[str, int]:
     return dict((c, tok) for c, txt, sent, w, tok in data)
 
 
+def refresh_stats(s: Session, storage: str = STORAGE) -> None:
+    """Recomputes the statistics of stats.html from the full tables,
+    to be run whenever texts or tokens change, rather than on every page view.
+    storage is where the words are, see word_hits()"""
+    stats = corpora_stats(s, storage)
+    tkns = corpora_token_counts(s, storage)
+    stemmer2vocab = get_stemmer2vocab(s, storage)
+    s.execute(delete(CorpusStats))
+    s.execute(delete(StemmerStats))
+    s.add_all(
+        CorpusStats(
+            corpus=c,
+            texts=texts,
+            sentences=sents,
+            words=words,
+            tokens=tkns.get(c, 0),
+        )
+        for c, (texts, sents, words) in stats.items()
+    )
+    s.add_all(
+        StemmerStats(stemmer=stem, token_class=value, count=cnt)
+        for value, counts in stemmer2vocab.items()
+        for stem, cnt in counts.items()
+    )
+    s.flush()
+
+
+TEXTS_PER_FETCH = 16
+"""Annotated texts fetched at a time by corpus_annotations()"""
+
+
+def annotated_texts(s: Session, stemmer: str):
+    """Texts with their annotated title and HTML, or their fulltext when not annotated yet"""
+    return s.query(
+        Text.id,
+        Text.name,
+        Annotation.title,
+        Annotation.html,
+        case((Annotation.html.is_(None), Text.fulltext), else_=None),
+    ).outerjoin(
+        Annotation,
+        and_(Annotation.text_id == Text.id, Annotation.stemmer == stemmer),
+    )
+
+
+def corpus_annotations(
+    s: Session, stemmer: str, corpus: str
+) -> Iterator[tuple[int, str, Optional[str], Optional[str], Optional[str]]]:
+    """The texts of a corpus by file name, with their annotated HTML,
+    fetched a few at a time so that pages can be streamed.
+    Texts not annotated yet come with their fulltext instead.
+
+    Returns:
+        Iterator[tuple[int, str, Optional[str], Optional[str], Optional[str]]]:
+            id, name, annotated title, html, fulltext
+    """
+    # in the order of the files on disk, which the collation of the database may not follow
+    fnames = s.query(Text.id, Text.fname).filter(Text.corpus == corpus)
+    ids = [text_id for text_id, _ in sorted(fnames, key=lambda t: f"{t.fname}.txt")]
+    for i in range(0, len(ids), TEXTS_PER_FETCH):
+        batch = ids[i : i + TEXTS_PER_FETCH]
+        found = {
+            row[0]: row
+            for row in annotated_texts(s, stemmer).filter(Text.id.in_(batch))
+        }
+        yield from (found[text_id] for text_id in batch)
+
+
+def text_annotation(
+    s: Session, stemmer: str, corpus: str, anchor: str
+) -> Optional[tuple[int, str, Optional[str], Optional[str], Optional[str]]]:
+    """The text of a corpus with the anchor of util.fname2path(), as in corpus_annotations()"""
+    # fname2path() lowercases the file name and drops a trailing "_"
+    return (
+        annotated_texts(s, stemmer)
+        .filter(
+            Text.corpus == corpus,
+            func.lower(Text.fname).in_([anchor, f"{anchor}_"]),
+        )
+        .order_by(Text.fname)
+        .first()
+    )
+
+
+Offsets = Optional[list[tuple[int, int, str]]]
+"""(start, end, token) of the valued words of a text, None when not stored"""
+
+
+def token_offsets(s: Session, stemmer: str, text_id: int) -> Offsets:
+    """The (start, end, token) of the words of a text that have a value,
+    in order of their offsets in the cleaned fulltext, see datamodel.annotate().
+    None for texts stored before the offsets were."""
+    return token_offsets_many(s, stemmer, [text_id])[text_id]
+
+
+def token_offsets_many(
+    s: Session, stemmer: str, text_ids: list[int]
+) -> dict[int, Offsets]:
+    """Same as token_offsets() for many texts, with a query per table"""
+    valued = select(Token.token_id).where(Token.stemmer == stemmer)
+    found: dict[int, Offsets] = {text_id: [] for text_id in text_ids}
+    if STORAGE != "arrays":
+        legacy = (
+            s.query(Sentence.text_id)
+            .filter(Sentence.text_id.in_(text_ids), Sentence.char_start.is_(None))
+            .distinct()
+        )
+        for (text_id,) in legacy:
+            found[text_id] = None
+        words = (
+            s.query(Sentence.text_id, Word.char_start, Word.char_end, Stem.token)
+            .join(Sentence, Sentence.id == Word.sentence_id)
+            .join(Stem, and_(Stem.form_id == Word.form_id, Stem.stemmer == stemmer))
+            .filter(Sentence.text_id.in_(text_ids), Stem.token_id.in_(valued))
+            .order_by(Sentence.text_id, Word.char_start)
+        )
+        for text_id, start, end, token in words:
+            offsets = found[text_id]
+            if offsets is not None:
+                offsets.append((start, end, token))
+        return found
+    packed = s.query(Sentence.id, Sentence.text_id, Sentence.offsets).filter(
+        Sentence.text_id.in_(text_ids)
+    )
+    offsets = {}
+    for sent_id, text_id, data in packed:
+        if data is None:
+            found[text_id] = None
+        else:
+            offsets[sent_id] = (text_id, unpack_ids(data))
+    hits = (
+        s.query(Posting.sentence_id, Posting.positions, Stem.token)
+        .join(Sentence, Sentence.id == Posting.sentence_id)
+        .join(Stem, and_(Stem.form_id == Posting.form_id, Stem.stemmer == stemmer))
+        .filter(Sentence.text_id.in_(text_ids), Stem.token_id.in_(valued))
+    )
+    for sent_id, positions, token in hits:
+        # sentences without offsets make their text None
+        text_id, sentence = offsets.get(sent_id, (0, []))
+        text_offsets = found.get(text_id)
+        if text_offsets is not None:
+            text_offsets += [
+                (sentence[2 * i], sentence[2 * i + 1], token)
+                for i in unpack_ids(positions)
+            ]
+    for text_offsets in found.values():
+        if text_offsets is not None:
+            text_offsets.sort()
+    return found
+
+
+def stored_corpora_stats(s: Session) -> dict[str, tuple[int, int, int, int]]:
+    """For each corpus: num. texts, num. sentences, num. words, num. tokens"""
+    data = s.query(
+        CorpusStats.corpus,
+        CorpusStats.texts,
+        CorpusStats.sentences,
+        CorpusStats.words,
+        CorpusStats.tokens,
+    ).order_by(CorpusStats.corpus)
+    return {c: (texts, sents, words, tkns) for c, texts, sents, words, tkns in data}
+
+
+def stored_stemmer2vocab(s: Session) -> dict[str, dict[str, int]]:
+    """Same as get_stemmer2vocab(), as of the last refresh_stats()"""
+    data = s.query(
+        StemmerStats.count, StemmerStats.stemmer, StemmerStats.token_class
+    ).order_by(StemmerStats.stemmer, StemmerStats.token_class)
+    result: dict[str, dict[str, int]] = {}
+    for cnt, stem, value in data:
+        result.setdefault(value, {})[stem] = cnt
+    return result
+
+
 if __name__ == "__main__":
-    s = Session()
-    stem = "wnl"
-    # values, valuesbackref = tokenize_values(s, stem)
-    # print(values)
-    # print(valuesbackref)
-    # fulltexts, tokenized = load_source()
-    # print(tokenized["full"])
+    with session_scope() as s:
+        stem = "wnl"
+        # values, valuesbackref = tokenize_values(s, stem)
+        # print(values)
+        # print(valuesbackref)
+        # fulltexts, tokenized = load_source()
+        # print(tokenized["full"])
@@ -0,0 +1,91 @@
+"""NLP resources shared by the whole process.
+Each resource is loaded on first use and then kept, so that nothing is loaded
+at import time or per call, and models no stemmer uses are never loaded.
+Loading is thread-safe: threads asking for a resource being loaded wait for it."""
+
+from typing import Any, Callable, TypeVar
+
+import os
+import inspect
+import threading
+from functools import wraps
+
+from settings import LANG, db_dir
+
+T = TypeVar("T")
+
+punkt_languages = {
+    "en": "english",
+    "it": "italian",
+}
+"""ISO language -> punkt model"""
+
+regex_token = r"\w+"
+
+
+def shared(load: Callable[..., T]) -> Callable[..., T]:
+    """Decorator: load(*args) runs once per process and arguments, under a lock"""
+    loaded: dict[tuple, Any] = {}
+    lock = threading.Lock()
+    signature = inspect.signature(load)
+
+    @wraps(load)
+    def get(*args) -> T:
+        # defaults are part of the key, so that f() and f(default) share a resource
+        bound = signature.bind(*args)
+        bound.apply_defaults()
+        key = bound.args
+        if key in loaded:
+            return loaded[key]
+        with lock:
+            if key not in loaded:
+                loaded[key] = load(*key)
+        return loaded[key]
+
+    return get
+
+
+@shared
+def sentence_tokenizer(lang: str = LANG):
+    """The punkt sentence tokenizer of the language, see punkt_languages"""
+    import nltk.data  # type: ignore
+
+    return nltk.data.load(f"tokenizers/punkt/{punkt_languages[lang]}.pickle")
+
+
+@shared
+def word_tokenizer(pattern: str = regex_token):
+    from nltk.tokenize import RegexpTokenizer  # type: ignore
+
+    return RegexpTokenizer(pattern)
+
+
+@shared
+def snowball(language: str):
+    from nltk.stem import SnowballStemmer  # type: ignore
+
+    return SnowballStemmer(language)
+
+
+@shared
+def wordnet():
+    from nltk.stem import WordNetLemmatizer  # type: ignore
+
+    return WordNetLemmatizer()
+
+
+@shared
+def porter():
+    from nltk.stem import PorterStemmer  # type: ignore
+
+    return PorterStemmer()
+
+
+@shared
+def morphemes(morph_dir: str = f"{db_dir}/morphemes"):
+    """The morphological parser of morphroot.py"""
+    from morphemes import Morphemes  # type: ignore
+
+    if not os.path.exists(morph_dir):
+        os.mkdir(morph_dir)
+    return Morphemes(morph_dir)
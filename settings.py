@@ -36,6 +36,24 @@ DATABASE_URL: Final = "postgresql://postgres:xxxxxx@db/postgres"
 # LANG: Final = "en"
 LANG: Final = os.environ["ISO_LANG"]
 
+# How tokenized texts are stored:
+# "rows" keeps a row per word, "arrays" packs each sentence into an array of word ids
+# with a positional inverted index on the side. Switching requires a full populate.
+STORAGE: Final = os.environ.get("STORAGE", "rows")
+
+# Processes rendering the heatmaps of main.py, 0 renders them in threads
+RENDER_WORKERS: Final = int(os.environ.get("RENDER_WORKERS", "2"))
+
+# Memory for the pages cached by main.py, see cache.py. With CACHE_SPILL_DIR set,
+# pages evicted from memory are kept on disk there, up to CACHE_SPILL_MB in all
+# (the directory is shared by the processes serving the same dataset)
+CACHE_MB: Final = int(os.environ.get("CACHE_MB", "64"))
+CACHE_SPILL_DIR: Final = os.environ.get("CACHE_SPILL_DIR", "")
+CACHE_SPILL_MB: Final = int(os.environ.get("CACHE_SPILL_MB", "512"))
+
+# Memory for the word vectors loaded by main.py, see vectors.py
+VECTORS_MB: Final = int(os.environ.get("VECTORS_MB", "1024"))
+
 # A clean dataset is bottom-up defined and has no vocabulary that does not occur.
 # An unclean is top-down (typically from a generic dictionary) and has many irrelevant or less relevant tokens.
 # Thus: 1) tokens are sorted by frequence, 2) missing tokens are not shown
@@ -1,19 +1,18 @@
 """Functionality related to the manipulation of similarity objects"""
-from typing import Dict, List, Mapping, Tuple
-from glob import glob
 
-import pandas as pd  # type: ignore
+from typing import TYPE_CHECKING, Dict, List, Mapping, Tuple, Union
+from glob import glob
 
-from bokeh.models import LinearColorMapper, LabelSet, ColumnDataSource  # type: ignore
 from palettes import pal_seq
-from bokeh.plotting import figure, show, output_file  # type: ignore
 
-from algo import algos
+from vectors import vectors
+
+if TYPE_CHECKING:
+    import pandas as pd  # type: ignore
 
 import numpy as np
 from palettes import pal_seq, pal_div
 
-
 viz_params = {"average": np.mean, "similarity": None, "shift": None, "stdev": np.std}
 viz_fns = {"average": "agg", "similarity": "sim", "shift": "shift", "stdev": "agg"}
 viz_pal = {
@@ -35,6 +34,121 @@ def last_available_iteration(
     return m
 
 
+Matrix = Tuple[np.ndarray, np.ndarray]
+"""Values between each pair of keywords, and the mask of the pairs that have one"""
+
+
+def unit_vectors(kv, keywords: List[str]) -> Matrix:
+    """The normalized vectors of the keywords as rows, gathered at once,
+    and the mask of the keywords that have a vector. Rows of the others are zero."""
+    matrix = np.zeros((len(keywords), kv.vector_size), dtype=kv.vectors.dtype)
+    known = np.array([k in kv.key_to_index for k in keywords], dtype=bool)
+    rows = np.flatnonzero(known)
+    matrix[rows] = kv.vectors[[kv.key_to_index[keywords[i]] for i in rows]]
+    # FastText composes the vectors of unknown words from their n-grams
+    for i in np.flatnonzero(~known):
+        try:
+            matrix[i] = kv.get_vector(keywords[i])
+            known[i] = True
+        except KeyError:
+            pass
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms), known
+
+
+def similarity_matrix(kv, keywords: List[str]) -> Matrix:
+    """Cosine similarity of all the pairs of keywords, as a single product"""
+    matrix, known = unit_vectors(kv, keywords)
+    mask = np.outer(known, known)
+    return np.where(mask, matrix @ matrix.T, 0), mask
+
+
+def sim_matrix(
+    keywords: List[str],
+    variant: Union[int, str],
+    tkn: str,
+    model_dir: str,
+    algo: str = "ft",
+    epochs: int = 200,
+    iteration: int = 0,
+) -> Matrix:
+    """Similarity in the model of a variant"""
+    model = vectors(f"{model_dir}/{variant}.{tkn}.e{epochs}.{algo}.{iteration}", algo)
+    return similarity_matrix(model, keywords)
+
+
+def shift_matrix(
+    keywords: List[str],
+    variant: int,
+    tkn: str,
+    model_dir: str,
+    algo: str = "ft",
+    epochs: int = 200,
+    iteration: int = 0,
+) -> Matrix:
+    """Similarity in the model of a variant, less the one in the base model"""
+    base, base_mask = sim_matrix(
+        keywords, "all", tkn, model_dir, algo, epochs, iteration
+    )
+    sim, mask = sim_matrix(keywords, variant, tkn, model_dir, algo, epochs, iteration)
+    mask = mask & base_mask
+    return np.where(mask, sim - base, 0), mask
+
+
+def agg_matrix(
+    agg,
+    keywords: List[str],
+    tkn: str,
+    model_dir: str,
+    algo: str = "ft",
+    epochs: int = 200,
+) -> Matrix:
+    """Similarity aggregated over the iterations of the base model.
+
+    :param func agg: a numpy reduction with an axis argument, e.g. np.mean
+    """
+    iterations = range(last_available_iteration(model_dir, tkn, algo, epochs))
+    if not iterations:
+        empty = np.zeros((len(keywords), len(keywords)))
+        return empty, empty.astype(bool)
+    sims, masks = zip(
+        *[
+            sim_matrix(keywords, "all", tkn, model_dir, algo, epochs, i)
+            for i in iterations
+        ]
+    )
+    mask = np.logical_and.reduce(masks)
+    return np.where(mask, agg(np.stack(sims), axis=0), 0), mask
+
+
+def matrix_dict(
+    matrix: Matrix, keywords: List[str], digits: int = 2
+) -> Dict[str, Dict[str, str]]:
+    """keyword -> keyword -> formatted value, the pairs without one are 0"""
+    values, mask = matrix
+    return {
+        k: {
+            x: f"{values[i, j] if mask[i, j] else 0:.{digits}f}"
+            for j, x in enumerate(keywords)
+        }
+        for i, k in enumerate(keywords)
+    }
+
+
+def matrix_frame(
+    matrix: Matrix, keywords: List[str], digits: int = 2
+) -> "pd.DataFrame":
+    """The data frame with columns (from, to, dist) that render() takes"""
+    import pandas as pd  # type: ignore
+
+    rows = [
+        (k, x, dist)
+        for k, dists in matrix_dict(matrix, keywords, digits).items()
+        for x, dist in dists.items()
+    ]
+    return pd.DataFrame(rows, columns=["from", "to", "dist"])
+
+
 def calc_sim(
     _,
     keywords: List[str],
@@ -49,23 +163,8 @@ def calc_sim(
     variant is one of 0, 1, 2, 3
     returns list of lists that can be given as parameter to constructor of dataframe
     """
-    model = algos[algo].load(
-        f"{model_dir}/{variant}.{tkn}.e{epochs}.{algo}.{iteration}"
-    )
-    d: Dict[str, Dict[str, str]] = {}
-    for i, k in enumerate(keywords):
-        if k not in d:
-            d[k] = {}
-        # d[k][k] = f"{model.wv.similarity(k, k):.2f}"
-        for x in keywords[i:]:
-            try:
-                d[k][x] = f"{model.wv.similarity(k, x):.2f}"
-            except KeyError:
-                d[k][x] = "0.00"
-            if x not in d:
-                d[x] = {}
-            d[x][k] = d[k][x]
-    return d
+    matrix = sim_matrix(keywords, variant, tkn, model_dir, algo, epochs, iteration)
+    return matrix_dict(matrix, keywords)
 
 
 def calc_shift(
@@ -82,24 +181,8 @@ def calc_shift(
     variant is one of 0, 1, 2, 3
     returns list of lists that can be given as parameter to constructor of dataframe
     """
-    m0 = algos[algo].load(f"{model_dir}/all.{tkn}.e{epochs}.{algo}.{iteration}")
-    model = algos[algo].load(
-        f"{model_dir}/{variant}.{tkn}.e{epochs}.{algo}.{iteration}"
-    )
-    d: Dict[str, Dict[str, str]] = {}
-    for i, k in enumerate(keywords):
-        if k not in d:
-            d[k] = {}
-        # d[k][k] = f"{model.wv.similarity(k, k):.2f}"
-        for x in keywords[i:]:
-            try:
-                d[k][x] = f"{model.wv.similarity(k, x)-m0.wv.similarity(k, x):.2f}"
-            except KeyError:
-                d[k][x] = "0.00"
-            if x not in d:
-                d[x] = {}
-            d[x][k] = d[k][x]
-    return d
+    matrix = shift_matrix(keywords, variant, tkn, model_dir, algo, epochs, iteration)
+    return matrix_dict(matrix, keywords)
 
 
 def calc_agg(
@@ -113,43 +196,27 @@ def calc_agg(
     iteration: int = 0,
 ):
     """
-    :param func agg: a function that takes a list
+    :param func agg: a numpy reduction with an axis argument, e.g. np.mean
     iteration is ignored
     variant is one of 0, 1, 2, 3
     returns list of lists that can be given as parameter to constructor of dataframe
     """
-    models = []
-    for iteration in range(last_available_iteration(model_dir, tkn, algo, epochs)):
-        models += [
-            algos[algo].load(f"{model_dir}/all.{tkn}.e{epochs}.{algo}.{iteration}")
-        ]
-    d: Dict[str, Dict[str, str]] = {}
-    for i, k in enumerate(keywords):
-        if k not in d:
-            d[k] = {}
-        # d[k][k] = f"{model.wv.similarity(k, k):.2f}"
-        for x in keywords[i:]:
-            try:
-                vals = [m.wv.similarity(k, x) for m in models]
-                # print(vals)
-                m = agg(vals)
-                d[k][x] = f"{m:0.3f}"
-            except KeyError:
-                d[k][x] = "0.000"
-            if x not in d:
-                d[x] = {}
-            d[x][k] = d[k][x]
-    return d
+    matrix = agg_matrix(agg, keywords, tkn, model_dir, algo, epochs)
+    return matrix_dict(matrix, keywords, 3)
 
 
 def render(
     title: str,
-    df: pd.DataFrame,
+    df: "pd.DataFrame",
     corpus: str = "all",
     fname: str = "distance.html",
     palette: Mapping[str, Tuple[str, ...]] = pal_seq,
 ):
     """Renders a similarity matrix from a dataframe with columns (from, to, dist)"""
+    import pandas as pd  # type: ignore
+    from bokeh.models import LinearColorMapper, LabelSet, ColumnDataSource  # type: ignore
+    from bokeh.plotting import figure, show, output_file  # type: ignore
+
     output_file(
         # filename=f"site/{tkn}/distance.html",
         filename=fname,
@@ -6,7 +6,11 @@ let init = () => {
     var fulltext = document.getElementById("fulltext");
     var values = document.getElementById("values");
 
+    // "<corpus>.html#<text>" is fetched as "<corpus>/<text>.html", the text only
+    let textURL = (url) => url.replace(/\/([^\/]+)\.html#([^\/#]+)$/, "/$1/$2.html");
+
     let tryUpdate = async (iPossiblyBogusURL) => {
+        iPossiblyBogusURL = textURL(iPossiblyBogusURL);
         const response = await fetch(iPossiblyBogusURL);
         
         if (response.status == 200) {
@@ -41,6 +45,17 @@ let init = () => {
         tryUpdate(url);
     }
 
+    // links of the lists open the text they point to, not its whole corpus
+    list.addEventListener('load', () => {
+        list.contentDocument.addEventListener('click', (event) => {
+            const link = event.target.closest("a[target='fulltext']");
+            if (link && link.href != textURL(link.href)) {
+                event.preventDefault();
+                tryUpdate(link.href);
+            }
+        });
+    });
+
     vocab.addEventListener('change', update);
     stemmer.addEventListener('change', update);
     corpus.addEventListener('change', update);
@@ -0,0 +1,128 @@
+"""Persistent word->stem cache, shared across runs and processes.
+Generalises what morphroot.py does by hand for morphemes to all the stemmers.
+The cache is an SQLite file in WAL mode, so concurrent readers and writers
+(populate.py workers, uvicorn workers) do not block each other.
+The stems of a stemmer are kept with the version of its definition,
+and dropped when a stemmer with another version loads them."""
+
+from typing import Optional
+
+import os
+import atexit
+import sqlite3
+import threading
+
+from settings import db_dir, LANG
+
+cache_file = f"{db_dir}/stems.sqlite"
+
+FLUSH_SIZE = 1000
+"""Number of new stems buffered before they are written"""
+
+LOOKUP_SIZE = 500
+"""Words looked up by a single query, below the variables allowed by SQLite"""
+
+lock = threading.Lock()
+conn: Optional[sqlite3.Connection] = None
+conn_pid: Optional[int] = None
+pending: list[tuple[str, str, str, str]] = []
+
+
+def connect() -> sqlite3.Connection:
+    """The connection of the current process, reopened after a fork"""
+    global conn, conn_pid
+    if conn is None or conn_pid != os.getpid():
+        if not os.path.exists(db_dir):
+            os.mkdir(db_dir)
+        conn = sqlite3.connect(
+            cache_file, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS stems (
+                stemmer TEXT NOT NULL,
+                lang TEXT NOT NULL,
+                word TEXT NOT NULL,
+                stem TEXT NOT NULL,
+                PRIMARY KEY (stemmer, lang, word)
+            ) WITHOUT ROWID"""
+        )
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS versions (
+                stemmer TEXT NOT NULL,
+                lang TEXT NOT NULL,
+                version TEXT NOT NULL,
+                PRIMARY KEY (stemmer, lang)
+            ) WITHOUT ROWID"""
+        )
+        # whatever was buffered before a fork is the parent's to write
+        pending.clear()
+        conn_pid = os.getpid()
+    return conn
+
+
+def load(stemmer: str, version: str, limit: int) -> dict[str, str]:
+    """Up to limit cached stems of a stemmer, to warm its memo at the first use.
+    The stems of another version of the stemmer are dropped first"""
+    with lock:
+        c = connect()
+        key = (stemmer, LANG)
+        row = c.execute(
+            "SELECT version FROM versions WHERE stemmer = ? AND lang = ?", key
+        ).fetchone()
+        if row is None or row[0] != version:
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("DELETE FROM stems WHERE stemmer = ? AND lang = ?", key)
+            c.execute(
+                "INSERT OR REPLACE INTO versions VALUES (?, ?, ?)", (*key, version)
+            )
+            c.execute("COMMIT")
+            return {}
+        return dict(
+            c.execute(
+                "SELECT word, stem FROM stems WHERE stemmer = ? AND lang = ? LIMIT ?",
+                (*key, limit),
+            )
+        )
+
+
+def get_many(stemmer: str, words: list[str]) -> dict[str, str]:
+    """The cached stems of the words that have one, LOOKUP_SIZE words per query"""
+    found: dict[str, str] = {}
+    with lock:
+        c = connect()
+        for i in range(0, len(words), LOOKUP_SIZE):
+            batch = words[i : i + LOOKUP_SIZE]
+            found.update(
+                c.execute(
+                    "SELECT word, stem FROM stems WHERE stemmer = ? AND lang = ?"
+                    f" AND word IN ({', '.join('?' * len(batch))})",
+                    (stemmer, LANG, *batch),
+                )
+            )
+    return found
+
+
+def put(stemmer: str, word: str, stem: str) -> None:
+    with lock:
+        connect()
+        pending.append((stemmer, LANG, word, stem))
+        full = len(pending) >= FLUSH_SIZE
+    if full:
+        flush()
+
+
+def flush() -> None:
+    """Writes the buffered stems. Stems are deterministic,
+    so a row written meanwhile by another process is simply kept."""
+    with lock:
+        if not pending or conn_pid != os.getpid():
+            return
+        c = connect()
+        c.execute("BEGIN IMMEDIATE")
+        c.executemany("INSERT OR IGNORE INTO stems VALUES (?, ?, ?, ?)", pending)
+        c.execute("COMMIT")
+        pending.clear()
+
+
+atexit.register(flush)
@@ -3,35 +3,48 @@ To our purposes SnowballStemmer appears to be the most reasonable.
 Also, notice dummy stemmer that leaves words as they are,
 so algoritms can also work without stemming."""
 
-import nltk  # type: ignore
-import simplemma
-import spacy
+from typing import Callable, Iterable
+
+import hashlib
+import threading
+from collections import OrderedDict
 
 from settings import LANG
 
-from morphroot import get_root_morpheme, roots
+import stemcache
+
+# Each stemmer/lemmatizer is built at its first use, once per process, see resources.py
+from resources import snowball, wordnet, porter
 
 # nltk.download("wordnet")
-nlp = spacy.load(f"{LANG}_core_web_lg")
+
+STEM_CACHE_SIZE = 2**18
+"""Number of word->stem results kept in memory per stemmer"""
+
+
+def simplemma_lemma(word: str, lang: str) -> str:
+    # imported at the first use, only the Italian stemmers need it
+    import simplemma  # type: ignore
+
+    return simplemma.lemmatize(word, lang=lang)
+
 
 # changes here need to also be reflected in static/index.html
 # en
 all_stemmers = {
     "en": {
         "dummy": lambda word, sent: word.lower(),
-        "wnl": lambda word, sent: nltk.stem.WordNetLemmatizer().lemmatize(word.lower()),
-        "sb": lambda word, sent: nltk.stem.SnowballStemmer("english").stem(
-            word.lower()
-        ),
+        "wnl": lambda word, sent: wordnet().lemmatize(word.lower()),
+        "sb": lambda word, sent: snowball("english").stem(word.lower()),
         # Double application of the Snowball Stemmer to ensure it is idempotent function over the values
-        # "sb2": lambda word, sent: nltk.stem.SnowballStemmer("english").stem(
-        #     nltk.stem.SnowballStemmer("english").stem(word.lower())
+        # "sb2": lambda word, sent: snowball("english").stem(
+        #     snowball("english").stem(word.lower())
         # ),
         # Snowball stemmer on lemmatized tokens
-        "sb-lem": lambda word, sent: nltk.stem.SnowballStemmer("english").stem(
-            nltk.stem.WordNetLemmatizer().lemmatize(word.lower())
+        "sb-lem": lambda word, sent: snowball("english").stem(
+            wordnet().lemmatize(word.lower())
         ),
-        "ps": lambda word, sent: nltk.stem.PorterStemmer().stem(word.lower()),
+        "ps": lambda word, sent: porter().stem(word.lower()),
         # "lan": lambda word, sent: nltk.stem.lancaster.LancasterStemmer().stem(
         #     word.lower()
         # ),
@@ -39,22 +52,93 @@ all_stemmers = {
     },
     "it": {
         "dummy": lambda word, sent: word.lower(),
-        "simpl": lambda word, sent: simplemma.lemmatize(word.lower(), lang="it"),
-        "sb": lambda word, sent: nltk.stem.SnowballStemmer("italian").stem(
-            word.lower()
-        ),
+        "simpl": lambda word, sent: simplemma_lemma(word.lower(), "it"),
+        "sb": lambda word, sent: snowball("italian").stem(word.lower()),
         # Double application of the Snowball Stemmer to ensure it is idempotent function over the values
-        "sb2": lambda word, sent: nltk.stem.SnowballStemmer("italian").stem(
-            nltk.stem.SnowballStemmer("italian").stem(word.lower())
+        "sb2": lambda word, sent: snowball("italian").stem(
+            snowball("italian").stem(word.lower())
         ),
-        "sb-lem": lambda word, sent: nltk.stem.SnowballStemmer("english").stem(
-            simplemma.lemmatize(word.lower(), lang="it")
+        "sb-lem": lambda word, sent: snowball("english").stem(
+            simplemma_lemma(word.lower(), "it")
         ),
     },
 }
 
 
-stemmers = all_stemmers[LANG]
+def definition(func: Callable) -> str:
+    """A hash of the code of a stemmer, the version of the stems it cached"""
+    code = func.__code__
+    return hashlib.sha1(
+        repr((code.co_code, code.co_consts, code.co_names)).encode()
+    ).hexdigest()
+
+
+class StemMemo:
+    """A stemmer with a bounded LRU of word->stem, warmed at its first use with the
+    stems of the persistent cache in stemcache.py, where new stems are written.
+    None of the stemmers looks at the sentence, so only the word is part of the key."""
+
+    def __init__(self, name: str, func: Callable[[str, list[str] | None], str]):
+        self.name = name
+        self.func = func
+        self.stems: OrderedDict[str, str] = OrderedDict()
+        self.warm = False
+        self.lock = threading.Lock()
+
+    def load(self) -> None:
+        with self.lock:
+            if not self.warm:
+                version = definition(self.func)
+                self.keep(stemcache.load(self.name, version, STEM_CACHE_SIZE))
+                self.warm = True
+
+    def keep(self, stems: dict[str, str]) -> None:
+        self.stems.update(stems)
+        while len(self.stems) > STEM_CACHE_SIZE:
+            self.stems.popitem(last=False)
+
+    def __call__(self, word: str, sent: list[str] | None = None) -> str:
+        if not self.warm:
+            self.load()
+        try:
+            self.stems.move_to_end(word)
+            return self.stems[word]
+        except KeyError:
+            stem = self.func(word, None)
+            stemcache.put(self.name, word, stem)
+            self.keep({word: stem})
+            return stem
+
+    def many(self, words: Iterable[str]) -> dict[str, str]:
+        """The stems of distinct words, those not in memory looked up in the
+        persistent cache at once, and only the rest stemmed"""
+        if not self.warm:
+            self.load()
+        distinct = list(dict.fromkeys(words))
+        missing = [w for w in distinct if w not in self.stems]
+        if missing:
+            self.keep(stemcache.get_many(self.name, missing))
+        return {w: self(w) for w in distinct}
+
+
+stemmers = {k: StemMemo(k, v) for k, v in all_stemmers[LANG].items()}
+
+
+def stem_many(stemmer: str, words: Iterable[str]) -> list[str]:
+    """Stems a batch of words, stemming each distinct word only once
+
+    Args:
+        stemmer (str): stemmer name as in stemmers
+        words (Iterable[str]): the words, possibly repeated
+
+    Returns:
+        list[str]: the stems, in the order of the words
+    """
+    words = list(words)
+    stems = stemmers[stemmer].many(words)
+    stemcache.flush()
+    return [stems[w] for w in words]
+
 
 stemmer_labels = {
     "dummy": "none (exact words)",
@@ -68,4 +152,4 @@ stemmer_labels = {
     "simpl": "Lemmatizer",
 }
 
-default_stemmer = "sb-lem"
\ No newline at end of file
+default_stemmer = "sb-lem"
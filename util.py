@@ -1,6 +1,6 @@
 """General functions without internal dependencies"""
 
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple, Iterable, Iterator
 
 import os
 import string
@@ -8,18 +8,12 @@ import itertools
 from glob import glob
 import filecmp
 import shutil
+import hashlib
+import struct
 from datetime import datetime
 
-from nltk import sent_tokenize, word_tokenize  # type: ignore
-from nltk.tokenize import RegexpTokenizer  # type: ignore
-
-from nltk.stem import WordNetLemmatizer  # type: ignore
-
-wnl = WordNetLemmatizer()
-
-regex_token = r"\w+"
-
 from settings import DATEFORMAT_LOG, VOCAB, CORPORA
+from resources import sentence_tokenizer, word_tokenizer
 
 
 # def clean_word(s: str) -> str:
@@ -129,16 +123,71 @@ def story_tokenize(story: str) -> list[list[str]]:
     >>> story_tokenize(lan, story)
     [['marry', 'marry']]
     """
-    tokens = []
-    words = []
-    tokenizer = RegexpTokenizer(regex_token)
+    return [
+        [story[start:end] for start, end in words] for *_, words in story_spans(story)
+    ]
+
+
+def story_spans(story: str) -> list[tuple[int, int, list[tuple[int, int]]]]:
+    """The sentences of a story as (start, end, words), with the (start, end)
+    of each word as story_tokenize() splits them. Offsets are in characters of the story.
+
+    >>> story_spans("Once upon a time. The end!")
+    [(0, 17, [(0, 4), (5, 9), (10, 11), (12, 16)]), (18, 26, [(18, 21), (22, 25)])]
+    """
+    spans = []
+    tokenizer = word_tokenizer()
+    for start, end in sentence_tokenizer().span_tokenize(story):
+        sentence = story[start:end]
+        words = [
+            (start + first, start + last)
+            for first, last in tokenizer.span_tokenize(sentence)
+            if sentence[first:last] not in string.punctuation + "\n"
+        ]
+        spans += [(start, end, words)]
+    return spans
+
+
+cleanup_map = {
+    "-\n": "",
+    "ſ": "s",
+}
+
+
+def clean_text(fulltext: str) -> str:
+    """The fulltext as annotated and tokenized, hyphenation and long s undone.
+    Stored offsets refer to it, see story_spans().
+
+    >>> clean_text("co-\\noperation")
+    'cooperation'
+    """
+    for k, v in cleanup_map.items():
+        fulltext = fulltext.replace(k, v)
+    return fulltext
+
+
+def content_hash(content: str) -> str:
+    """Fingerprint of a text, used to detect changes between ingestions.
+
+    >>> content_hash("Once upon a time")[:16]
+    'e286222c229ec73b'
+    """
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
 
-    sentences = sent_tokenize(story)
-    for i, sentence in enumerate(sentences):
-        # doc = word_tokenize(sentence)
-        doc = tokenizer.tokenize(sentence)
-        words += [[t for t in doc if t not in string.punctuation + "\n"]]
-    return words
+
+def pack_ids(ids: List[int]) -> bytes:
+    """Compact binary array of unsigned ints, as stored by the arrays storage.
+
+    >>> pack_ids([1, 256])
+    b'\\x01\\x00\\x00\\x00\\x00\\x01\\x00\\x00'
+    >>> unpack_ids(pack_ids([3, 1, 4]))
+    [3, 1, 4]
+    """
+    return struct.pack(f"<{len(ids)}I", *ids)
+
+
+def unpack_ids(data: bytes) -> List[int]:
+    return list(struct.unpack(f"<{len(data) // 4}I", data))
 
 
 def word2tokens(token_func, story: list[list[str]]) -> list[list[str]]:
@@ -162,14 +211,30 @@ def collect_tokens(
 
 
     """
-    result = []
-    if corpus:
-        # result = list(tokenized[corpus].values())
-        result = list(itertools.chain(*list(tokenized[corpus].values())))
-    else:
-        for c in tokenized.keys():
-            result += collect_tokens(tokenized, c)
-    return result
+    source = (
+        (c, text, sentences)
+        for c, texts in tokenized.items()
+        for text, sentences in texts.items()
+    )
+    return list(iter_tokens(source, corpus))
+
+
+def iter_tokens(
+    source: Iterable[Tuple[str, str, List[List[str]]]],
+    corpus: Optional[str] = None,
+) -> Iterator[List[str]]:
+    """Streaming collect_tokens() over (corpus, text, sentences), e.g. from query.iter_source()
+
+    >>> data = [('A', '1', [['aa', 'bb'], ['cc']]), ('B', 'I', [['a', 'b']])]
+    >>> list(iter_tokens(data, 'B'))
+    [['a', 'b']]
+
+    >>> list(iter_tokens(data))
+    [['aa', 'bb'], ['cc'], ['a', 'b']]
+    """
+    for c, _, sentences in source:
+        if not corpus or c == corpus:
+            yield from sentences
 
 
 def rmdirs():
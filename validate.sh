@@ -14,6 +14,9 @@ mypy .
 echo '>>> Running Pytest on util.py'
 pytest --doctest-modules -s util.py # -vv --disable-warnings
 
+echo '>>> Checking the imports of main.py'
+python importtime.py main
+
 echo '>>> Running Black'
 black .
 
@@ -0,0 +1,130 @@
+"""Word vectors of the models created by createmodel.py, shared by the pages.
+Pages only compare words, so only the KeyedVectors of a model are loaded, without
+its vocabulary counts and training state. createmodel.py saves them next to each model
+as <model>.kv, they are memory-mapped read only, so that all the processes serving
+pages share a single copy through the page cache.
+Loaded vectors are kept in an LRU bounded by VECTORS_MB, see vectors_stats()."""
+
+from typing import Any
+
+import os
+import threading
+from collections import OrderedDict
+
+from settings import VECTORS_MB
+from algo import algos
+
+
+def kv_path(model_path: str) -> str:
+    """Where the vectors of a model are saved"""
+    return f"{model_path}.kv"
+
+
+def save_vectors(wv, model_path: str) -> None:
+    """Saves the vectors of a model, every array in a file of its own to be mapped"""
+    wv.save(kv_path(model_path), sep_limit=0)
+
+
+def vectors_size(kv) -> int:
+    """Bytes of the arrays of KeyedVectors, with the n-grams of FastText"""
+    arrays = [getattr(kv, name, None) for name in ["vectors", "vectors_ngrams"]]
+    return sum(a.nbytes for a in arrays if a is not None)
+
+
+def load_vectors(model_path: str, algo: str):
+    """The vectors of a model, memory-mapped. The vectors of models saved
+    before the .kv files were are extracted from the model once, and saved"""
+    from gensim.models import KeyedVectors  # type: ignore
+
+    path = kv_path(model_path)
+    if not os.path.exists(path):
+        wv = algos[algo].load(model_path).wv
+        try:
+            save_vectors(wv, model_path)
+        except OSError:
+            # read-only models, kept in memory instead
+            return wv
+    return KeyedVectors.load(path, mmap="r")
+
+
+class VectorRegistry:
+    """LRU of the loaded vectors, bounded in bytes.
+    The vectors last used are always kept, even when larger than the budget."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[str, tuple[Any, int]] = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.loading: dict[str, threading.Lock] = {}
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def get(self, model_path: str, algo: str):
+        with self.lock:
+            if model_path in self.entries:
+                return self.hit(model_path)
+            loading = self.loading.setdefault(model_path, threading.Lock())
+        # legacy models are loaded in full, so other models are served meanwhile,
+        # while a model is loaded, and its vectors saved, by one thread at a time
+        with loading:
+            with self.lock:
+                if model_path in self.entries:
+                    return self.hit(model_path)
+            try:
+                kv = load_vectors(model_path, algo)
+            except BaseException:
+                with self.lock:
+                    self.done_loading(model_path, loading)
+                raise
+            with self.lock:
+                self.done_loading(model_path, loading)
+                if model_path in self.entries:
+                    return self.hit(model_path)
+                self.loads += 1
+                size = vectors_size(kv)
+                self.entries[model_path] = (kv, size)
+                self.size += size
+                while self.size > self.max_bytes and len(self.entries) > 1:
+                    _, (_, evicted) = self.entries.popitem(last=False)
+                    self.size -= evicted
+                    self.evictions += 1
+                return kv
+
+    def done_loading(self, model_path: str, loading: threading.Lock) -> None:
+        """Forgets the lock of a load, unless a later load took its place"""
+        if self.loading.get(model_path) is loading:
+            del self.loading[model_path]
+
+    def hit(self, model_path: str):
+        """The loaded vectors of a model, to be called holding the lock"""
+        self.hits += 1
+        self.entries.move_to_end(model_path)
+        return self.entries[model_path][0]
+
+    def stats(self) -> dict[str, object]:
+        with self.lock:
+            return {
+                "resident": len(self.entries),
+                "resident_mb": self.size / 2**20,
+                "budget_mb": self.max_bytes / 2**20,
+                "hits": self.hits,
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / max(self.hits + self.loads, 1),
+            }
+
+
+registry = VectorRegistry(VECTORS_MB * 2**20)
+
+
+def vectors(model_path: str, algo: str):
+    """The KeyedVectors of a model saved by createmodel.py, loaded once per process.
+    Raises FileNotFoundError for a missing model, as loading the model does."""
+    return registry.get(model_path, algo)
+
+
+def vectors_stats() -> dict[str, object]:
+    """Loads and hits of the vectors, to size VECTORS_MB"""
+    return registry.stats()
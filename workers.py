@@ -0,0 +1,45 @@
+"""Worker processes for the CPU-bound rendering of main.py.
+Database and disk work runs in the thread pool of FastAPI (plain `def` routes),
+CPU-bound work would hold the GIL there, so it runs in processes of its own."""
+
+from typing import Callable, Optional, TypeVar
+
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from starlette.concurrency import run_in_threadpool  # type: ignore
+
+from settings import RENDER_WORKERS
+
+T = TypeVar("T")
+
+executor: Optional[ProcessPoolExecutor] = None
+
+
+def processes() -> ProcessPoolExecutor:
+    """The pool, started on first use"""
+    global executor
+    if executor is None:
+        # spawned, forking a server that runs threads is unsafe
+        executor = ProcessPoolExecutor(
+            RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return executor
+
+
+async def run_in_process(func: Callable[..., T], *args) -> T:
+    """Runs func in a worker process without blocking the event loop.
+    func is a module level function and args are plain data, as both are pickled.
+    With RENDER_WORKERS=0 it runs in a thread instead."""
+    if not RENDER_WORKERS:
+        return await run_in_threadpool(func, *args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(processes(), func, *args)
+
+
+def shutdown() -> None:
+    global executor
+    if executor is not None:
+        executor.shutdown(cancel_futures=True)
+        executor = None